@@ -1,10 +1,11 @@
 from .dem           import DEMInversion
 from .dem_hgm       import GaussianModel, HierarchicalGaussianModel
 from .dem_dx        import compute_dx 
-from .dem_structs   import dotdict, cdotdict, cell
+from .dem_structs   import dotdict, cdotdict, dxvp, cell
 from .dem_z         import dem_z 
 from .dem_viz       import Colorbar, plot_dem_states, plot_dem_generate
-from .dem_symb      import compute_sym_df_d2f, compile_symb_func, compile_symb_func_delays, compute_sym_df_d2f_delays
+from .dem_symb      import compute_sym_df_d2f, compute_sym_df_d2f_many, compile_symb_func, compile_symb_func_delays, compute_sym_df_d2f_delays
+from .dem_num       import compute_num_df_d2f
 from .dem_defaults  import dem_defaults
 
 from .special_matrices import *
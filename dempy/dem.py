@@ -3,6 +3,9 @@ import logging
 
 from tqdm.autonotebook import tqdm
 from itertools import chain
+from functools import lru_cache
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, List
 
 from .dem_de import *
@@ -16,6 +19,70 @@ from .utils import *
 logging.basicConfig()
 
 
+@njit(cache=True)
+def _d_step_flow(E, dEdu, dEdy, dEdc, iS, Pu, dWdu, dWduu, u, D, K, dFdu, dFduu): 
+    """ Variational flow of the D-step, f = K * dF/du + D @ u, and its Jacobian dfdu 
+    dFdu and dFduu are buffers in which only the blocks of u = (x, v) are updated. 
+    """
+    nxv = dEdu.shape[1]
+    ny  = dEdy.shape[1]
+    nc  = dEdc.shape[1]
+    nj  = nxv + ny + nc
+
+    # stack [dE/du, dE/dy, dE/dc, E] so that all products with the 
+    # gradient dE/du' @ iS are computed in a single matrix product
+    rhs = np.empty((E.shape[0], nj + 1))
+    rhs[:, :nxv]          = dEdu
+    rhs[:, nxv:nxv + ny]  = dEdy
+    rhs[:, nxv + ny:nj]   = dEdc
+    rhs[:, nj:]           = E
+    dV  = - (dEdu.T @ iS) @ rhs
+
+    # gradient (first-order derivatives)
+    dFdu[:nxv]        = dV[:, nj:] - dWdu / 2 - Pu @ u[:nxv]
+
+    # Jacobian (variational flow: second-order derivatives)
+    dFduu[:nxv, :]    = dV[:, :nj]
+    dFduu[:nxv, :nxv] = dFduu[:nxv, :nxv] - dWduu / 2 - Pu
+
+    f    = K * dFdu  + D @ u
+    dfdu = K * dFduu + D
+
+    return f, dfdu
+
+
+@njit(cache=True)
+def _generate_flow(x, v, z, w, dgdx, dgdv, dfdx, dfdv, J, u, Du): 
+    """ Higher orders of the generalized states x and causes v of generate, and the 
+    blocks kron(shift, dg) and kron(eye, df) of the Jacobian J of the flow on u = (v, x, z, w). 
+    x, v, z and w are views on the buffer u, and D @ u is stored in the buffer Du.
+    """
+    n  = x.shape[0]
+    nx = x.shape[1]
+    nv = v.shape[1]
+    Nv = n * nv
+    Nx = n * nx
+
+    # compute higher orders
+    for i in range(1, n - 1): 
+        v[i]   = dgdx @ x[i] + dgdv @ v[i] + z[i]
+        x[i+1] = dfdx @ x[i] + dfdv @ v[i] + w[i]
+
+    # Jacobian
+    for k in range(n): 
+        J[Nv + k*nx:Nv + (k+1)*nx, k*nv:(k+1)*nv]           = dfdv
+        J[Nv + k*nx:Nv + (k+1)*nx, Nv + k*nx:Nv + (k+1)*nx] = dfdx
+        if k < n - 1: 
+            J[k*nv:(k+1)*nv, (k+1)*nv:(k+2)*nv]             = dgdv
+            J[k*nv:(k+1)*nv, Nv + (k+1)*nx:Nv + (k+2)*nx]   = dgdx
+
+    # derivative D @ u (shift of each component of u = (v, x, z, w))
+    i0 = 0
+    for m in (nv, nx, nv, nx): 
+        Du[i0:i0 + n*m - m] = u[i0 + m:i0 + n*m]
+        i0 += n * m
+
+
 class DEMInversion: 
     def __init__(self, 
                  systems: HierarchicalGaussianModel, 
@@ -31,13 +98,32 @@ class DEMInversion:
             self.d  : int  = self.n                          # embedding order of causes
 
         self.nl : int  = len(systems)                        # number of levels
-        self.nv : int  = sum(M.m for M in self.M)            # number of v (causal states)
-        self.nx : int  = sum(M.n for M in self.M)            # number of x (hidden states)
+        self.nv : int  = int(self.M.ms.sum())                # number of v (causal states)
+        self.nx : int  = int(self.M.ns.sum())                # number of x (hidden states)
         self.ny : int  = self.M[0].l                         # number of y (model output)
         self.nc : int  = self.M[-1].l                        # number of c (prior causes)
         self.nu : int  = self.d * self.nv + self.n * self.nx # number of generalized states
         self.logger    = logging.getLogger('[DEM]')
 
+        # derivatives for Jacobian of D-step (only depend on dimensions)
+        # --------------------------------------------------------------
+        self.D  : np.ndarray = DEMInversion._derivative_operator(
+            self.n, self.d, self.nx, self.nv, self.ny, self.nc)  # derivative operator on u = (x, v, y, c)
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _derivative_operator(n: int, d: int, nx: int, nv: int, ny: int, nc: int): 
+        # shared by all inversions of models with the same dimensions (read-only)
+        Dx              = kron(np.diag(np.ones((n-1,)), 1), np.eye(nx))
+        Dv              = kron(           np.zeros((n, n)), np.eye(nv))
+        Dv[:nv*d,:nv*d] = kron(np.diag(np.ones((d-1,)), 1), np.eye(nv))
+        Dy              = kron(np.diag(np.ones((n-1,)), 1), np.eye(ny))
+        Dc              = kron(           np.zeros((n, n)), np.eye(nc))
+        Dc[:nc*d,:nc*d] = kron(np.diag(np.ones((d-1,)), 1), np.eye(nc))
+        D               = block_diag(Dx, Dv, Dy, Dc)
+        D.setflags(write=False)
+        return D
+
     @staticmethod
     def generalized_covariance(
         p   : int,            # derivative order  
@@ -46,7 +132,13 @@ class DEMInversion:
         ):
         """ Mimics the behavior of spm_DEM_R.m by Karl Friston
         s is the roughtness of the noise process. 
+        Results are cached, and returned as read-only arrays. 
         """
+        return DEMInversion._generalized_covariance(int(p), float(s), bool(cov))
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _generalized_covariance(p: int, s: float, cov: bool):
         if s == 0:
             s = np.exp(-8)
 
@@ -62,6 +154,9 @@ class DEMInversion:
 
         R = np.linalg.inv(S)
 
+        S.setflags(write=False)
+        R.setflags(write=False)
+
         if cov: 
             return S, R
         else: return R
@@ -80,35 +175,49 @@ class DEMInversion:
         
         # Make sure the input is a numpy array 
         x     = np.array(x, dtype='d')
-        
+
+        E, ts, k = DEMInversion._embedding_operators(int(n_times), int(p), float(dt))
+
+        # apply each distinct operator to all the windows it is shared by
+        X     = np.empty((n_times, p, dim))
+        for Ei, ti in zip(E, ts): 
+            X[ti] = Ei @ x[k[ti] - 1]
+
+        return X
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _embedding_operators(n_times: int, p: int, dt: float): 
+        # operators of generalized_coordinates, shared by all series of the same length (read-only)
+
         # Time and embedding order
-        times = np.arange(1, n_times + 1)
+        times = np.arange(1, n_times + 1, dtype='d')
         ks    = np.arange(1, p + 1)
-        
-        # Taylor's expansion forward (T) and inverse (E) operators
-        T = np.empty((p, p), dtype='d')
-        E = np.empty((p, p), dtype='d')
-        
-        # Embedded time series (for output)
-        X = np.zeros((n_times, p, dim))
-        
-        for t in times:
-            k = ks + int(np.fix(float(t) - (p + 1) / 2))
-            y = float(t) - min(k) + 1
-            k = np.clip(k, 1, n_times)
-
-            # Create T_ij(t) (note that indices start at 0) 
-            for i in range(p): 
-                for j in range(p): 
-                    T[i, j] = float( ((i - y + 1) * dt)**j / np.math.factorial(j))
-            
-            # Compute E
-            E[:] = np.linalg.inv(T)
-            
-            # Embed
-            X[t - 1] = E @ x[k - 1]
+        js    = np.arange(p)
+        fact  = np.cumprod(np.concatenate(([1.], np.arange(1, p, dtype='d'))))[:p] # j! for j < p
 
-        return X
+        # Window of samples around each time t (shape (n_times, p))
+        k0 = np.fix(times - (p + 1) / 2).astype(int)
+        k  = ks[None, :] + k0[:, None]
+        y  = times - k0
+        k  = np.clip(k, 1, n_times)
+
+        # The operators only depend on the offset y of t in its window, which is the same for all t
+        # but the first few ones (the operator is Toeplitz away from the start of the series), so we
+        # only build one operator per distinct offset, along with the times it applies to
+        yu, iy = np.unique(y, return_inverse=True)
+        ts     = tuple(np.flatnonzero(iy == i) for i in range(len(yu)))
+
+        # Taylor's expansion forward (T) operators T_ij(y) (note that indices start at 0)
+        base = (js[None, :] - yu[:, None] + 1) * dt
+        T    = base[:, :, None] ** js[None, None, :] / fact
+
+        # Inverse (E) operators, and samples of the series to embed
+        E = np.linalg.inv(T)
+
+        for a in (E, k, *ts): 
+            a.setflags(write=False)
+        return E, ts, k
 
 
     def run(self, 
@@ -124,6 +233,25 @@ class DEMInversion:
             Emin: int = 0, 
             Mmin: int = 0, 
             ):
+        # the levels are evaluated in a thread pool (of M._n_jobs threads) that only lives for this run
+        n_jobs = getattr(self.M, '_n_jobs', 1)
+        with ThreadPoolExecutor(max_workers=n_jobs) if n_jobs is not None and n_jobs > 1 and self.nl > 2 else nullcontext() as pool: 
+            return self._run(y, u, x, nD, nE, nM, K, tol, td, Emin, Mmin, pool=pool)
+
+    def _run(self, 
+            y   : np.ndarray,                       # Observed timeseries with shape (time, dimension) 
+            u   : Optional[np.ndarray] = None,      # Explanatory variables, inputs or prior expectation of causes
+            x   : Optional[np.ndarray] = None,      # Confounds
+            nD  : int = 1,                          # Number of D-steps 
+            nE  : int = 8,                          # Number of E-steps
+            nM  : int = 8,                          # Number of M-steps 
+            K   : int = 1,                          # Learning rate
+            tol : float = np.exp(-4),               # Numerical tolerance
+            td  : Optional[float] = None,           # Integration time 
+            Emin: int = 0, 
+            Mmin: int = 0, 
+            pool: Optional[ThreadPoolExecutor] = None,  # executor for the levels (see run)
+            ):
         log = self.logger
         # Adapted from spm_DEM (and other dependencies) by Karl Friston 
         """ 
@@ -158,7 +286,7 @@ class DEMInversion:
 
         # conditional moments
         # -------------------
-        qU : List[dotdict]       = list()     # conditional moments of model states - q(u) for each time t
+        qU : dotdict             = dotdict()  # conditional moments of model states - q(u), stacked over time t
         qP : dotdict             = dotdict()  # conditional moments of model parameters - q(p)
         qH : dotdict             = dotdict()  # conditional moments of model hyperparameters - q(h)
         qu : dotdict             = dotdict()  # loop variable for qU
@@ -167,7 +295,7 @@ class DEMInversion:
 
         # loop variables 
         # ------
-        qE  : List[dotdict]      = list()               # errors
+        qE  : np.ndarray         = None                 # errors, stacked over time t
         B   : dotdict            = dotdict()            # saved states
         F   : np.ndarray       = np.zeros(nE)      # Free-energy
         A   : np.ndarray       = np.zeros(nE)      # Free-action
@@ -212,57 +340,60 @@ class DEMInversion:
 
         # precision components Q requiring [Re]ML estimators (M-step)
         # -----------------------------------------------------------
-        Q    = []
-        v0, w0 = [], []
-        for i in range(nl):
-            v0.append(np.zeros((M[i].l, M[i].l)))
-            w0.append(np.zeros((M[i].n, M[i].n)))
-        V0 = kron(np.zeros((n,n)), block_diag(*v0))
-        W0 = kron(np.zeros((n,n)), block_diag(*w0))
-        Qp = block_diag(V0, W0)
+        ne   = sum(M[i].l for i in range(nl))   # number of causal errors
+        nq   = n * (ne + nx)                    # number of generalized errors
+        Qp   = np.zeros((nq, nq))
+
+        # number of hyperparameters
+        # -------------------------
+        nh : int = sum(len(M[i].Q) + len(M[i].R) for i in range(nl))
+
+        # components are written in place in a (nh, nq, nq) tensor, such that the precision 
+        # can be [re-]set with a single contraction
+        Q    = np.zeros((nh, nq, nq))
+        ih   = 0
 
         # Qp is: 
         # ((ny*n,    0,    0)
         #  (   0, n*nv,    0)
         #  (   0,    0, n*nx) 
 
-
+        # components only touch the rows and columns of their own level, i.e. 
+        # kron(iV, block_diag(0, ..., q, ..., 0)), so we assemble them in place 
+        iev, iew = 0, n * ne 
         for i in range(nl): 
             # Precision (R) and covariance of generalized errors
             # --------------------------------------------------
             iVv    = DEMInversion.generalized_covariance(n, M[i].sv * M.dt)
             iVw    = DEMInversion.generalized_covariance(n, M[i].sw * M.dt)
 
+            # indices of the generalized errors of level i
+            jv     = (np.arange(n)[:, None] * ne + iev + np.arange(M[i].l)).reshape((-1,))
+            jw     = (np.arange(n)[:, None] * nx + iew + np.arange(M[i].n)).reshape((-1,))
+            jv     = np.ix_(jv, jv)
+            jw     = np.ix_(jw, jw)
+            iev   += M[i].l
+            iew   += M[i].n
+
             # noise on causal states (Q)
             # --------------------------
             for j in range(len(M[i].Q)): 
-                q    = list(v0)
-                q[i] = M[i].Q[j]
-                Q.append(block_diag(kron(iVv, block_diag(*q)), W0))
+                Q[ih][jv] = kron(iVv, M[i].Q[j])
+                ih       += 1
 
             # and fixed components (V) 
             # ------------------------
-            q    = list(v0)
-            q[i] = M[i].V
-            Qp  += block_diag(kron(iVv, block_diag(*q)), W0)
-
+            Qp[jv] += kron(iVv, M[i].V)
 
             # noise on hidden states (R)
             # --------------------------
             for j in range(len(M[i].R)): 
-                q    = list(w0)
-                q[i] = M[i].R[j]
-                Q.append(block_diag(V0, kron(iVw, block_diag(*q))))
+                Q[ih][jw] = kron(iVw, M[i].R[j])
+                ih       += 1
 
             # and fixed components (W) 
             # ------------------------
-            q    = list(w0)
-            q[i] = M[i].W
-            Qp  += block_diag(V0, kron(iVw, block_diag(*q)))
-
-        # number of hyperparameters
-        # -------------------------
-        nh : int = len(Q)  
+            Qp[jw] += kron(iVw, M[i].W)
 
         # fixed priors on states (u) 
         # --------------------------
@@ -283,7 +414,11 @@ class DEMInversion:
         ph.c  = block_diag(*hgC)                # prior covariance on h
         qh.h  = ph.h.copy()                     # conditional expecatation 
         qh.c  = ph.c.copy()                     # conditional covariance
-        ph.ic = np.linalg.pinv(ph.c)            # prior precision      
+        qh.e  = qh.h - ph.h                     # conditional prediction error
+        try:                                    # prior precision      
+            ph.ic = cho_inv(ph.c)
+        except np.linalg.LinAlgError:           # e.g. fixed hyperparameters (null prior variances)
+            ph.ic = np.linalg.pinv(ph.c)
 
         # priors on parameters (in reduced parameter space)
         # =================================================
@@ -312,7 +447,10 @@ class DEMInversion:
         ip    = slice(0,nP)
         ib    = slice(nP,nP + nn)
         pp.c  = block_diag(*pp.c)
-        pp.ic = np.linalg.inv(pp.c)
+        try: 
+            pp.ic = cho_inv(pp.c)
+        except np.linalg.LinAlgError:           # numerically indefinite
+            pp.ic = np.linalg.inv(pp.c)
         pp.p  = np.concatenate(qp.p)
 
         # initialize conditional density q(p) := qp.e (for D-step)
@@ -338,8 +476,21 @@ class DEMInversion:
 
         # initialize arrays for D-step
         # ============================
-        qu.x = np.zeros((n, nx))
-        qu.v = np.zeros((n, nv))
+        # conditional modes u = (x, v, y, c) and their update q, as column buffers;
+        # qu.x and qu.v are views on q, and the u_* are views on u
+        iux  = slice(0, n * nx)
+        iuv  = slice(n * nx, n * (nx + nv))
+        iuy  = slice(n * (nx + nv), n * (nx + nv + ny))
+        iuu  = slice(n * (nx + nv + ny), n * (nx + nv + ny + nc))
+        u    = np.zeros(((nx + nv + ny + nc) * n, 1))
+        q    = np.zeros(((nx + nv + ny + nc) * n, 1))
+        u_x  = u[iux].reshape((n, nx))
+        u_v  = u[iuv].reshape((n, nv))
+        u_y  = u[iuy].reshape((n, ny))
+        u_u  = u[iuu].reshape((n, nc))
+
+        qu.x = q[iux].reshape((n, nx))
+        qu.v = q[iuv].reshape((n, nv))
         qu.y = np.zeros((n, ny))
         qu.u = np.zeros((n, nc))
 
@@ -350,15 +501,19 @@ class DEMInversion:
         if nv > 0: 
             qu.v[0, :] = np.concatenate([M[i].v for i in range(1,   nl)], axis=0).squeeze()
 
+        # conditional moments and errors at each time t (struct of arrays)
+        # responses and inputs do not change over iterations: share Y and U
+        qU.x = np.zeros((nT, n, nx))
+        qU.v = np.zeros((nT, n, nv))
+        qU.y = Y
+        qU.u = U
+        qU.p = np.zeros((nT, (nx + nv) * n, (nx + nv) * n))
+        qU.c = np.zeros((nT, (nx + nv) * n, (nx + nv) * n))
+        qE   = np.zeros((nT, n * (sum(M[i].l for i in range(nl)) + nx)))
+
         # derivatives for Jacobian of D-step 
         # ----------------------------------
-        Dx              = kron(np.diag(np.ones((n-1,)), 1), np.eye(nx))
-        Dv              = kron(           np.zeros((n, n)), np.eye(nv))
-        Dv[:nv*d,:nv*d] = kron(np.diag(np.ones((d-1,)), 1), np.eye(nv))
-        Dy              = kron(np.diag(np.ones((n-1,)), 1), np.eye(ny))
-        Dc              = kron(           np.zeros((n, n)), np.eye(nc))
-        Dc[:nc*d,:nc*d] = kron(np.diag(np.ones((d-1,)), 1), np.eye(nc))
-        D               = block_diag(Dx, Dv, Dy, Dc)
+        D               = self.D
 
         # and null blocks
         # ---------------
@@ -369,14 +524,29 @@ class DEMInversion:
 
         # gradients and curvatures for conditional uncertainty
         # ----------------------------------------------------
-        dWdu  = np.zeros((nu, 1))
+        nxv   = (nx + nv) * n
+        dWdu  = np.zeros((nxv, 1))
         dWdp  = np.zeros((nf, 1))
-        dWduu = np.zeros((nu, nu))
+        dWduu = np.zeros((nxv, nxv))
         dWdpp = np.zeros((nf, nf))
 
+        # scratch buffers (shapes are invariant across iterations)
+        # --------------------------------------------------------
+        quc   = np.zeros((nxv, nxv))                    # conditional covariance
+        qup   = np.zeros((nu, nu), order='F')           # Cholesky factor of the conditional precision
+
+        # gradient and Jacobian of the variational flow, whose (y, c) blocks are fixed
+        # ----------------------------------------------------------------------------
+        dFdu  = np.zeros((D.shape[0], 1))
+        dFduu = np.zeros(D.shape)
+        dFdu[iuy]       = dVdy
+        dFdu[iuu]       = dVdc
+        dFduu[iuy, iuy] = dVdyy
+        dFduu[iuu, iuu] = dVdcc
+
         # preclude unnecessary iterations
         # -------------------------------
-        if nh == 0: nM = 1
+        if nh == 0: nM = 0                      # no hyperparameters: no M-step at all
         if nf == 0 and nh == 0: nE = 1
 
         # prepare progress bars 
@@ -391,6 +561,9 @@ class DEMInversion:
         iv = slice(ny*n,ny*n + nv*d)
         je = np.diag(Qp) < np.exp(16)
         ju = np.concatenate([je[ix], je[iv]])
+        iju = np.ix_(ju, ju)
+        nju = np.ix_(~ju, ~ju)
+        Iju = np.asfortranarray(np.eye(nu)[:, ju])
 
         # E-step: (with) embedded D- and M-steps) 
         # =======================================
@@ -413,7 +586,7 @@ class DEMInversion:
 
             # [re-]set precisions using ReML hyperparameter estimates
             # -------------------------------------------------------
-            iS  = Qp + sum(Q[i] * np.exp(qh.h[i]) for i in range(nh))
+            iS  = Qp + np.tensordot(np.exp(qh.h[:, 0]), Q, axes=1)
 
             # [re-]adjust for confounds
             # -------------------------
@@ -422,7 +595,9 @@ class DEMInversion:
 
             # [re-]set states & their derivatives
             # -----------------------------------
-            qu = qU[0] if iE > 0 else qu
+            if iE > 0: 
+                qu.x[:] = qU.x[0]
+                qu.v[:] = qU.v[0]
 
             # D-step: (nD D-steps for each sample) 
             # ====================================
@@ -435,8 +610,9 @@ class DEMInversion:
 
                 # [re-]set states for static systems
                 # ----------------------------------
-                if nx == 0:
-                    qu = qU[iT] if len(qU) > iT else qu
+                if nx == 0 and iE > 0:
+                    qu.x[:] = qU.x[iT]
+                    qu.v[:] = qU.v[iT]
                 
                 # D-step: until convergence for static systems
                 # ============================================ 
@@ -448,8 +624,8 @@ class DEMInversion:
 
                     # derivatives of responses and inputs
                     # -----------------------------------
-                    qu.y  = Y[iT].copy()
-                    qu.u  = U[iT].copy()
+                    qu.y  = Y[iT]
+                    qu.u  = U[iT]
 
                     # compute dEdb (derivatives of confounds)
                     # NotImplemented 
@@ -457,18 +633,25 @@ class DEMInversion:
                     # evaluatefunction: 
                     # E = v - g(x,v) and derivatives dE.dx
                     # ====================================
-                    E, dE = dem_eval_err_diff(n, d, M, qu, qp)
+                    E, dE = dem_eval_err_diff(n, d, M, qu, qp, pool=pool)
 
                     # conditional covariance [of states u]
                     # ------------------------------------
                     qu.p         = dE.du.T @ iS @ dE.du + Pu
-                    quc          = np.zeros(((nv+nx)*n, (nv+nx)*n))
-                    quc[:nu,:nu] = np.diag(ju.astype(np.float64)) @ np.linalg.inv(qu.p[:nu,:nu]) @ np.diag(ju.astype(np.float64)) 
-                    qu.c         = quc
+                    qup[:, :]    = qu.p[:nu,:nu]
                     # differs from spm_DEM: we use ju to select components of quc that are not very precise
                     # otherwise, some rows and cols of quc are set to 0, and therefore the det is 0
                     # In SPM, this is done internally by spm_logdet 
-                    iqu.c        = iqu.c + np.linalg.slogdet(quc[ju][:, ju])[1] 
+                    # nb: quc[ju][:, ju] = inv(qu.p)[ju][:, ju], whose log-determinant is (Schur complement) 
+                    # logdet(qu.p[~ju][:, ~ju]) - logdet(qu.p)
+                    try: 
+                        qupc     = cho_factor(qup, overwrite_a=True)
+                        quc[iju] = cho_solve(qupc, Iju)[ju]
+                        iqu.c    = iqu.c + cho_logdet(cho_factor(qu.p[:nu,:nu][nju])) - cho_logdet(qupc)
+                    except np.linalg.LinAlgError:   # numerically indefinite
+                        quc[iju] = np.linalg.inv(qu.p[:nu,:nu])[iju]
+                        iqu.c    = iqu.c + np.linalg.slogdet(quc[iju])[1]
+                    qu.c         = quc
 
                     # and conditional covariance [of parameters P]
                     # --------------------------------------------
@@ -476,28 +659,22 @@ class DEMInversion:
                     ECEu  = dE.du @ qu.c @ dE.du.T
                     ECEp  = dE.dp @ qp.c @ dE.dp.T
 
-                    if nx == 0: 
-                        pass 
-
                     # save states at iT
                     if iD == 0: 
-                        if iE == 0:
-                            qE.append(E.squeeze(1))
-                            qU.append(dotdict({k: v.copy() for k, v in qu.items()})) 
-                        else: 
-                            qE[iT] = E.squeeze(1)
-                            qU[iT] = dotdict({k: v.copy() for k, v in qu.items()})
+                        qE[iT]   = E.squeeze(1)
+                        qU.x[iT] = qu.x
+                        qU.v[iT] = qu.v
+                        qU.p[iT] = qu.p
+                        qU.c[iT] = qu.c
 
                     # uncertainty about parameters dWdv, ...
+                    # (iS and qp.c are symmetric, so we keep the layout of dE.dpu, and contract 
+                    # C-contiguous operands that tensordot does not have to copy)
                     if nP > 0: 
-                        CJp   = np.zeros((iS.shape[0] * nP, (nx + nv) * n))
-                        dEdpu = np.zeros((iS.shape[0] * nP, (nx + nv) * n))
-                        for i in range((nx + nv) * n): 
-                            CJp[:, i]   = (qp.c[ip,ip] @ dE.dpu[i].T @ iS).reshape((-1,))
-                            dEdpu[:, i] = (dE.dpu[i].T).reshape((-1,))
+                        CJp   = iS @ dE.dpu @ qp.c[ip,ip]
 
-                        dWdu  = CJp.T @ (dE.dp.T).reshape((-1,1))
-                        dWduu = CJp.T @ dEdpu
+                        dWdu[:, 0] = np.tensordot(CJp, dE.dp,  axes=([1, 2], [0, 1]))
+                        dWduu[:]   = np.tensordot(CJp, dE.dpu, axes=([1, 2], [1, 2]))
 
 
                     # D-step update: of causes v[i] and hidden states x[i]
@@ -505,48 +682,26 @@ class DEMInversion:
 
                     # conditional modes
                     # -----------------
-                    u = np.concatenate([qu.x.reshape((-1,1)), qu.v.reshape((-1,1)), qu.y.reshape((-1,1)), qu.u.reshape((-1,1))])
-                    # store gradient with precision as it appears a lot after
-                    dEdu_iS = dE.du.T @ iS
-
-                    # first-order derivatives
-                    dVdu    = - dEdu_iS @ E - dWdu/2 - Pu @ u[0:(nx+nv)*n]
-
-                    # second-order derivatives
-                    dVduu   = - dEdu_iS @ dE.du - dWduu / 2 - Pu
-                    dVduy   = - dEdu_iS @ dE.dy 
-                    dVduc   = - dEdu_iS @ dE.dc
-                    
-                    # gradient
-                    dFdu = np.concatenate([dVdu.reshape((-1,)), dVdy.reshape((-1,)), dVdc.reshape((-1,))], axis=0)
-
-                    # Jacobian (variational flow)
-                    dFduu = block_matrix([[dVduu, dVduy, dVduc],
-                                          [   [], dVdyy,    []],
-                                          [   [],    [], dVdcc]])
+                    u_x[:] = qu.x
+                    u_v[:] = qu.v
+                    u_y[:] = qu.y
+                    u_u[:] = qu.u
 
                     # update conditional modes of states
-                    f     = K * dFdu[..., None]  + D @ u
-                    dfdu  = K * dFduu + D
+                    f, dfdu = _d_step_flow(E, dE.du, dE.dy, dE.dc, iS, Pu, dWdu, dWduu, u, D, K, dFdu, dFduu)
                     du    = compute_dx(f, dfdu, td * dt)
-                    q     = u + du
+                    np.add(u, du, out=q)
 
-                    # ... and save them 
-                    qu.x = q[:n * nx].reshape((n, nx))
-                    qu.v = q[n * nx:n * (nx + nv)].reshape((n, nv))
+                    # ... and save them (qu.x and qu.v are views on q)
 
                     # ommit part for static models
 
                 # Gradients and curvatures for E-step 
 
                 if nP > 0: 
-                    CJu     = np.zeros(((nx + nv) * n * iS.shape[0], nP))
-                    dEdup   = np.zeros(((nx + nv) * n * iS.shape[0], nP))
-                    for i in range(nP): 
-                        CJu[:, i]   = (qu.c @ dE.dup[i].T @ iS).reshape((-1,))
-                        dEdup[:, i] = (dE.dup[i].T).reshape((-1,))
-                    dWdp[ip]        = CJu.T @ (dE.du.T).reshape((-1,1))
-                    dWdpp[ip,ip]    = CJu.T @ dEdup
+                    CJu             = iS @ dE.dup @ qu.c
+                    dWdp[ip, 0]     = np.tensordot(CJu, dE.du,  axes=([1, 2], [0, 1]))
+                    dWdpp[ip,ip]    = np.tensordot(CJu, dE.dup, axes=([1, 2], [1, 2]))
 
                 # store gradient with precision as it appears a lot after
                 dEdP_iS = dE.dP.T @ iS
@@ -562,24 +717,30 @@ class DEMInversion:
 
             # M-step - optimize hyperparameters (mh = total update)
             mh = np.zeros((nh,))
+            eh = np.exp(qh.h[:, 0]) # scaling of the precision components in iS
             if nM > 1: 
                 Mbar.reset()
             for iM in range(nM): 
                 # [re-]set precisions using ReML hyperparameter estimates
-                iS    = Qp + sum(Q[i] * np.exp(qh.h[i]) for i in range(nh))
-                S     = np.linalg.inv(iS)
+                # (iS is updated incrementally from the change in hyperparameters)
+                deh   = np.exp(qh.h[:, 0]) - eh
+                if np.any(deh): 
+                    iS    = iS + np.tensordot(deh, Q, axes=1)
+                    eh    = eh + deh
+                iSc   = cho_factor(iS)
+                S     = cho_solve(iSc, np.eye(nq, order='F'), overwrite_b=True)
                 dS    = ECE + EE - S * nT 
 
                 # 1st order derivatives 
-                dPdh = [None for _ in range(nh)]
-                for i in range(nh): 
-                    dPdh[i] = Q[i] * np.exp(qh.h[i])
-                    dFdh[i] = - np.trace(dPdh[i] @ dS) / 2
+                # (all components are solved at once, and traces of products are reduced
+                # as tensor contractions, such that all work is done by (multithreaded) BLAS)
+                dPdh  = Q * np.exp(qh.h)[..., None]
+                SdPdh = cho_solve(iSc, dPdh.transpose((1, 0, 2)).reshape((nq, nh * nq)))
+                SdPdh = SdPdh.reshape((nq, nh, nq)).transpose((1, 0, 2))
+                dFdh[:, :] = - np.tensordot(dPdh, dS, axes=([1, 2], [1, 0]))[:, None] / 2
 
                 # 2nd order derivatives 
-                for i in range(nh): 
-                    for j in range(nh): 
-                        dFdhh[i, j] = - np.trace(dPdh[i] @ S @ dPdh[j] @ S * nT)/ 2
+                dFdhh[:, :] = - np.tensordot(SdPdh, SdPdh, axes=([1, 2], [2, 1])) * nT / 2
 
                 # hyperpriors
                 qh.e        = qh.h - ph.h
@@ -594,11 +755,14 @@ class DEMInversion:
                     qh.h = qh.h + dh 
                     mh   = mh + dh
 
-                # conditional covariance of hyperparameters 
-                qh.c = np.linalg.inv(dFdhh)
+                # conditional covariance of hyperparameters (dFdhh is negative definite)
+                try: 
+                    qh.c = -cho_inv(-dFdhh)
+                except np.linalg.LinAlgError: 
+                    qh.c = np.linalg.inv(dFdhh)
 
                 # convergence (M-step)
-                if nh > 0 and (((dFdh.T @ dh).squeeze() < tol) or np.linalg.norm(dh, 1) < tol) and iM > Mmin: 
+                if nh > 0 and (((dFdh.T @ dh).squeeze() < tol) or np.abs(dh).sum() < tol) and iM > Mmin: 
                     break
 
                 if nM > 1: 
@@ -610,16 +774,24 @@ class DEMInversion:
             # conditional precision of parameters
             # -----------------------------------
             qp.ic[ip, ip] = qp.ic[ip, ip] + pp.ic
-            qp.c = np.linalg.inv(qp.ic)
+            try: 
+                qp.c = cho_inv(qp.ic)
+            except np.linalg.LinAlgError:       # numerically indefinite
+                qp.c = np.linalg.inv(qp.ic)
 
             # evaluate objective function F
             # =============================
 
             # free-energy and action 
             # ----------------------
+            try: 
+                lSe = cho_logdet(cho_factor(iS[je][:, je]))
+            except np.linalg.LinAlgError:       # numerically indefinite
+                lSe = np.linalg.slogdet(iS[je][:, je])[1]
+
             Lu = - np.trace(iS[je][:, je] @ EE[je][:, je]) / 2 \
                  - n * ny * np.log(2 * np.pi) * nT / 2\
-                 + np.linalg.slogdet(iS[je][:, je])[1] * nT / 2\
+                 + lSe * nT / 2\
                  + iqu.c / (2*nD)
 
             Lp = - np.trace(qp.e.T @ pp.ic @ qp.e) / 2\
@@ -698,7 +870,7 @@ class DEMInversion:
                 
                 # otherwise, return to previous expansion point
                 # ---------------------------------------------
-                nM      = 1;
+                nM      = min(nM, 1)
                 qp      = dotdict(**B.qp)
                 pp      = dotdict(**B.pp)
                 qh      = dotdict(**B.qh)
@@ -721,8 +893,8 @@ class DEMInversion:
 
 
             # Check convergence 
-            if (np.linalg.norm(dp.reshape((-1,)), 1) < tol * np.linalg.norm(np.concatenate(qp.p).reshape((-1,)), 1)\
-                 and np.linalg.norm(mh.reshape((-1,)), 1) < tol) and iE > Emin: 
+            if iE > Emin and np.abs(mh).sum() < tol \
+                    and np.abs(dp).sum() < tol * sum(np.abs(p).sum() for p in qp.p): 
                 break 
             if te < -8: 
                 break
@@ -754,31 +926,22 @@ class DEMInversion:
         ip0  = 0
         for i in range(nl-1): 
             if M[i].constraints is not None:
-                ips = slice(ip0, ip0 + M[i].pE.size)
-
-                qP.P[ips][M[i].cpos]   =   np.exp(M[i].cpE[M[i].cpos] + np.sqrt(M[i].cpC[M[i].cpos]) * qP.P[ips][M[i].cpos])
-                qP.P[ips][M[i].cneg]   = - np.exp(M[i].cpE[M[i].cneg] + np.sqrt(M[i].cpC[M[i].cneg]) * qP.P[ips][M[i].cneg])
+                # positive and negative constraints, with integer indices into the full parameter vector
+                # (transform of the mode and variance, then removal of the constraints, in one pass)
+                for c, sgn in ((M[i].cpos, 1), (M[i].cneg, -1)): 
+                    idx = ip0 + np.flatnonzero(c)
+                    cpC = M[i].cpC[c]
 
-                qP.V[ips][M[i].cpos] =   qP.P.squeeze()[ips][M[i].cpos] * np.exp(M[i].cpC[M[i].cpos] * qP.V[ips][M[i].cpos] / 2) * np.sqrt(np.exp(M[i].cpC[M[i].cpos] * qP.V[ips][M[i].cpos]) - 1)
-                qP.V[ips][M[i].cneg] = - qP.P.squeeze()[ips][M[i].cneg] * np.exp(M[i].cpC[M[i].cneg] * qP.V[ips][M[i].cneg] / 2) * np.sqrt(np.exp(M[i].cpC[M[i].cneg] * qP.V[ips][M[i].cneg]) - 1)
+                    P         = sgn * np.exp(M[i].cpE[c] + np.sqrt(cpC) * qP.P[idx])
+                    eCV       = np.exp(cpC * qP.V[idx])
+                    qP.V[idx] = sgn * P[:, 0] * np.sqrt(eCV) * np.sqrt(eCV - 1)
+                    qP.P[idx] = sgn * (np.exp(P) - 1)
 
-            ip0 += M[i].pE.size
-
-
-        # u[M[i].csel, :] *= puq[M[i].csel] * np.sqrt(M[i].cpC[M[i].csel])[:, None]
-
-        # remove constraints
-        npi     = 0
-        for i in range(nl - 1): 
-            qppi = qP.P[npi:npi + M[i].nP]
-            qppi[M[i].constraints == 'positive'] =  np.exp(qppi[M[i].constraints == 'positive']) - 1
-            qppi[M[i].constraints == 'negative'] = -np.exp(qppi[M[i].constraints == 'negative']) + 1
-            qP.P[npi:npi + M[i].nP] = qppi
-            npi += M[i].nP
+            ip0 += M[i].nP
 
         results.qP = qP
 
-        results.qU = dotdict({k: np.stack([qU[i][k] for i in range(len(qU))], axis=0) for k in qU[0].keys()})
+        results.qU = qU
         results.qE = qE
         
 
@@ -791,8 +954,12 @@ class DEMInversion:
         M  = self.M
         dt = self.M.dt
         nl = len(M)                 # Number of levels
-        nx = sum(m.n for m in M)    # Number of states
-        nv = sum(m.l for m in M)    # Number of outputs
+        nx = int(M.ns.sum())        # Number of states
+        nv = int(M.ls.sum())        # Number of outputs
+
+        for i in range(nl - 1): 
+            if M[i].df is None or M[i].dg is None: 
+                raise ValueError(f'Derivatives of model[{i}] are missing: models must be prepared by HierarchicalGaussianModel.')
 
         z, w  = dem_z(M, nT)
         # inputs are integrated as random innovations
@@ -808,14 +975,46 @@ class DEMInversion:
         X[0, 0] = np.concatenate([m.x for m in M if m.n > 0], axis=0)
         V[0, 0] = np.concatenate([m.v for m in M if m.l > 0], axis=0)
 
-        # Derivatives operators
-        Dx = kron(np.diag(np.ones((n-1,)), 1), np.eye(nx));
-        Dv = kron(np.diag(np.ones((n-1,)), 1), np.eye(nv));
-        D  = block_diag(Dv, Dx, Dv, Dx)
-        dfdw  = kron(np.eye(n),np.eye(nx));
-
-        xt = X[0]
-        vt = V[0]
+        # Jacobian of the flow on u = (v, x, z, w), whose blocks are kronecker products 
+        # of the form kron(shift, A) and kron(eye, A), with A = dg/dv, dg/dx, df/dv or df/dx. 
+        # The constant blocks (derivative operators Dv, Dx and dfdw = I) are set once, 
+        # and the others are written at each step by _generate_flow. 
+        Nv = n * nv
+        Nx = n * nx
+        iv = slice(0, Nv)
+        ix = slice(Nv, Nv + Nx)
+        iz = slice(Nv + Nx, 2 * Nv + Nx)
+        iw = slice(2 * Nv + Nx, 2 * (Nv + Nx))
+
+        J    = np.zeros((2 * (Nv + Nx), 2 * (Nv + Nx)))
+        k0   = np.arange(n - 1)         # block rows of the shift operator 
+        k1   = np.arange(1, n)          # ... and their block columns
+
+        J[iv, iz].reshape((n, nv, n, nv))[k0, :, k1, :] = np.eye(nv)   # Dv
+        J[iz, iz].reshape((n, nv, n, nv))[k0, :, k1, :] = np.eye(nv)   # Dv
+        J[iw, iw].reshape((n, nx, n, nx))[k0, :, k1, :] = np.eye(nx)   # Dx
+        J[ix, iw]                                       = np.eye(Nx)   # dfdw
+        
+        # D @ u, with D = block_diag(Dv, Dx, Dv, Dx), shifts each of v, x, z, w by one order
+        Du   = np.zeros((2 * (Nv + Nx), 1))
+
+        # u = (v, x, z, w), and views on its components
+        u    = np.zeros((2 * (Nv + Nx), 1))
+        vt   = u[iv].reshape((n, nv, 1))
+        xt   = u[ix].reshape((n, nx, 1))
+        zt   = u[iz].reshape((n, nv, 1))
+        wt   = u[iw].reshape((n, nx, 1))
+
+        # partial derivatives (block matrices over levels, whose blocks are overwritten at each step)
+        ox   = np.cumsum([0] + [m.n for m in M])      # offsets of the states of each level 
+        ov   = np.cumsum([0] + [m.l for m in M])      # ... and of their outputs
+        dfdx = np.zeros((nx, nx))
+        dfdv = np.zeros((nx, nv))
+        dgdx = np.zeros((nv, nx))
+        dgdv = np.zeros((nv, nv))
+
+        xt[:] = X[0]
+        vt[:] = V[0]
         for t in tqdm(range(0, nT)):     
             # Unpack state
             zi = [_[t] for _ in Z]
@@ -826,10 +1025,6 @@ class DEMInversion:
             nvi = 0
             xi  = []
             vi  = []
-            dfdx = cell(nl, nl)
-            dfdv = cell(nl, nl)
-            dgdx = cell(nl, nl)
-            dgdv = cell(nl, nl)
             for i in range(nl): 
                 xi.append(xt[:, nxi:nxi + M[i].n])
                 vi.append(vt[:, nvi:nvi + M[i].l])
@@ -837,12 +1032,6 @@ class DEMInversion:
                 nxi = nxi + M[i].n
                 nvi = nvi + M[i].l
                 
-                # Fill cells 
-                dfdx[i, i] = np.zeros((M[i].n, M[i].n))
-                dfdv[i, i] = np.zeros((M[i].n, M[i].l))
-                dgdx[i, i] = np.zeros((M[i].l, M[i].n))
-                dgdv[i, i] = np.zeros((M[i].l, M[i].l))
-                
             f   = []
             g   = []
             df  = []
@@ -859,27 +1048,22 @@ class DEMInversion:
                 
                 xv = tuple(_ if sum(_.shape) > 0 else np.empty(_.shape) for _ in  (xi[i][0], vi[i+1][0]))
                 
-                # compute derivatives
-                if M[i].df is not None:
-                    dfi = M[i].df(*xv, M[i].pE)
-                else: 
-                    dfi, _ = compute_df_d2f(lambda x, v: M[i].f(x, v, M[i].pE), xv, ['dx', 'dv'])
-
-                if M[i].dg is not None:
-                    dgi = M[i].dg(*xv, M[i].pE)
-                else:
-                    dgi, _ = compute_df_d2f(lambda x, v: M[i].g(x, v, M[i].pE), xv, ['dx', 'dv']) 
+                # compute derivatives (compiled once by HierarchicalGaussianModel)
+                dfi = M[i].df(*xv, p)
+                dgi = M[i].dg(*xv, p)
 
                 # g(x, v) && f(x, v)
                 vi[i][0] = gi + zi[i][0]
                 f.append(fi)
                 g.append(gi)
                 
-                # and partial derivatives
-                dfdx[i,     i] = dfi.dx
-                dfdv[i, i + 1] = dfi.dv
-                dgdx[i,     i] = dgi.dx
-                dgdv[i, i + 1] = dgi.dv
+                # and partial derivatives, stamped in place at blocks (i, i) and (i, i + 1)
+                for a, e, r, c in ((dfdx, dfi.dx, ox[i], ox[i]    ), 
+                                   (dfdv, dfi.dv, ox[i], ov[i + 1]), 
+                                   (dgdx, dgi.dx, ov[i], ox[i]    ), 
+                                   (dgdv, dgi.dv, ov[i], ov[i + 1])): 
+                    if e.size > 0: 
+                        a[r:r + e.shape[0], c:c + e.shape[1]] = e
                 
                 df.append(dfi)
                 dg.append(dgi)
@@ -887,49 +1071,22 @@ class DEMInversion:
             f = np.concatenate(f)
             g = np.concatenate(g)
             
-            dfdx = block_matrix(dfdx)
-            dfdv = block_matrix(dfdv)
-            dgdx = block_matrix(dgdx)
-            dgdv = block_matrix(dgdv)
-            
-            v = np.concatenate(vi, axis=1)
-            x = np.concatenate(xi, axis=1) 
+            # (the levels xi and vi are views on xt and vt)
+            np.concatenate(zi, axis=1, out=zt)
+            np.concatenate(wi, axis=1, out=wt)
 
-            z = np.concatenate(zi, axis=1)
-            w = np.concatenate(wi, axis=1)
+            xt[1, :] = f + wt[0]
 
-            # x[0, :] = 
-
-            x[1, :] = f + w[0]
-
-            # compute higher orders
-            for i in range(1, n-1): 
-                v[i]   = dgdx @ x[i] + dgdv @ v[i] + z[i]
-                x[i+1] = dfdx @ x[i] + dfdv @ v[i] + w[i]
-            
-            dgdv = kron(np.diag(np.ones((n-1,)),1), dgdv)
-            dgdx = kron(np.diag(np.ones((n-1,)),1), dgdx)
-            dfdv = kron_eye(dfdv, n)
-            dfdx = kron_eye(dfdx, n)
+            # compute higher orders, and the Jacobian of the flow
+            _generate_flow(xt, vt, zt, wt, dgdx, dgdv, dfdx, dfdv, J, u, Du)
 
             # Save realization
-            V[t] = v.copy()
-            X[t] = x.copy()
+            V[t] = vt
+            X[t] = xt
             
-            J    = block_matrix([
-                [dgdv, dgdx,   Dv,   []] , 
-                [dfdv, dfdx,   [], dfdw],  
-                [[],     [],   Dv,   []],  
-                [[],     [],   [],   Dx]   
-            ])
-            
-            u  = np.concatenate([v.reshape((-1,)), x.reshape((-1,)), z.reshape((-1,)), w.reshape((-1,))])[..., None]
-            du = compute_dx(D @ u, J, dt)
+            du = compute_dx_nilpotent(Du, J, dt, Nv + Nx, n)  # (z, w) only evolve through Dv, Dx
 
-            u  = u + du
-            
-            vt   = u[:v.shape[0] * v.shape[1]].reshape(v.shape)
-            xt   = u[ v.shape[0] * v.shape[1]:v.shape[0] * v.shape[1] + x.shape[0] * x.shape[1]].reshape(x.shape)
+            np.add(u, du, out=u)
     
         # end - tqdm(range(0, nT)) 
 
@@ -1,5 +1,8 @@
 import numpy as np
 
+from functools import lru_cache
+from concurrent.futures import Executor
+
 from .dem_structs import *
 from .dem_hgm import *
 from .dem_dx import *
@@ -11,7 +14,83 @@ def as_matrix_it(*args):
         else: 
             yield arg.reshape((0, 1)) 
 
-def dem_eval_err_diff(n: int, d: int, M: HierarchicalGaussianModel, qu: dotdict, qp: dotdict): 
+@lru_cache(maxsize=None)
+def _dem_err_constants(n: int, d: int, ne: int, nx: int, ny: int, nc: int): 
+    # derivatives of the prediction error that only depend on the model structure
+    # (returned read-only, since they are shared across calls)
+    dedy = np.eye(ne, ny)
+    dedc = np.diag(-np.ones(max(ne, nc) - (nc - ne)), nc - ne)[:ne, :nc]
+
+    # embed to n >= d
+    dEdy = np.zeros((n*(ne + nx), n*ny))
+    dEdc = np.zeros((n*(ne + nx), n*nc))
+    dEdy[:n*ne]         = kron_eye(dedy, n)
+    dEdc[:n*ne,:d*nc]   = kron_eye(dedc, n, d) # kron(np.eye(n, d), de.dc)
+
+    # derivative operator on x, as in df.dx = (I * df.dx) - D, Eq. 45
+    Dx   = kron(np.diag(np.ones(n - 1), 1), np.eye(nx, nx))
+
+    # diagonal blocks of kron(np.eye(n, n), .) and kron(np.eye(n, d), .)
+    kn   = np.arange(n)
+    kd   = np.arange(min(n, d))
+
+    for a in (dedy, dedc, dEdy, dEdc, Dx, kn, kd): 
+        a.setflags(write=False)
+    return dedy, dedc, dEdy, dEdc, Dx, kn, kd
+
+def _eval_level(Mi: GaussianModel, i: int, xi: np.ndarray, vi: np.ndarray, q: np.ndarray, u: np.ndarray): 
+    # f, g and their derivatives at level i, with parameters p = pE + u @ q 
+    xi,vi,q,u,p = (_ if sum(_.shape) > 0 else np.empty(0) for _ in  (xi, vi, q, u, Mi.pE))
+    puq = p + u @ q
+
+    if Mi.constraints is not None:
+        # evaluate at mode 
+        puq[Mi.cpos] =   np.exp(Mi.cpE[Mi.cpos] + np.sqrt(Mi.cpC[Mi.cpos]) * puq[Mi.cpos])
+        puq[Mi.cneg] = - np.exp(Mi.cpE[Mi.cneg] + np.sqrt(Mi.cpC[Mi.cneg]) * puq[Mi.cneg])
+
+        u[Mi.csel, :] *= puq[Mi.csel] * np.sqrt(Mi.cpC[Mi.csel])[:, None]
+     
+
+    xvp = (xi, vi, puq)
+    xvp = tuple(as_matrix_it(*xvp))
+
+    try: 
+        f = Mi.f(*xvp)
+    except Exception as e: 
+        raise RuntimeError(f"Error while evaluating model[{i}].f!") from e
+
+    try: 
+        g = Mi.g(*xvp)
+    except Exception as e: 
+        raise RuntimeError(f"Error while evaluating model[{i}].g!") from e
+
+    dfi  = Mi.df(*xvp)
+    d2fi = Mi.d2f(*xvp)
+    dgi  = Mi.dg(*xvp)
+    d2gi = Mi.d2g(*xvp) 
+
+    dfi.dp = dfi.dp @ u
+    dgi.dp = dgi.dp @ u
+
+    d2fi.dx.dp = d2fi.dx.dp @ u
+    d2fi.dv.dp = d2fi.dv.dp @ u
+    d2fi.dv.dx = d2fi.dx.dv.swapaxes(1, 2)
+    d2fi.dp.dx = d2fi.dx.dp.swapaxes(1, 2)
+    d2fi.dp.dv = d2fi.dv.dp.swapaxes(1, 2)
+
+    d2fi.dp.dp = np.einsum('ik,aij,jl->akl', u, d2fi.dp.dp, u)
+
+    d2gi.dx.dp = d2gi.dx.dp @ u
+    d2gi.dv.dp = d2gi.dv.dp @ u
+    d2gi.dv.dx = d2gi.dx.dv.swapaxes(1, 2)
+    d2gi.dp.dx = d2gi.dx.dp.swapaxes(1, 2)
+    d2gi.dp.dv = d2gi.dv.dp.swapaxes(1, 2)
+
+    d2gi.dp.dp = np.einsum('ik,aij,jl->akl', u, d2gi.dp.dp, u)
+
+    return f, g, dfi, d2fi, dgi, d2gi
+
+def dem_eval_err_diff(n: int, d: int, M: HierarchicalGaussianModel, qu: dotdict, qp: dotdict, pool: Executor = None): 
     # inspired by spm_DEM_eval_diff and other deps., by Karl Friston 
 
     # Get dimensions
@@ -24,86 +103,25 @@ def dem_eval_err_diff(n: int, d: int, M: HierarchicalGaussianModel, qu: dotdict,
     ny = M[0].l
     nc = M[-1].l
 
-    # Evaluate functions at each level
-    # ================================
-    f = []
-    g = []
+    # Evaluate functions and derivatives at each level
+    # (levels are independent, and are evaluated in the executor pool if any)
+    # ================================================
     x = []
     v = []
     nxi = 0
     nvi = 0
-
-
-    # Evaluate derivatives at each level
-    df  = list()
-    d2f = list()
-    dg  = list()
-    d2g = list()
     for i in range(nl - 1):
-        xi  = qu.x[0, nxi:nxi + M[i].n]
-        vi  = qu.v[0, nvi:nvi + M[i].m]
+        x.append(qu.x[0, nxi:nxi + M[i].n])
+        v.append(qu.v[0, nvi:nvi + M[i].m])
 
         nxi = nxi + M[i].n
         nvi = nvi + M[i].m
 
-        x.append(xi)
-        v.append(vi)
-        
-        xi,vi,q,u,p = (_ if sum(_.shape) > 0 else np.empty(0) for _ in  (x[i], v[i], qp.p[i], qp.u[i], M[i].pE))
-        puq = p + u @ q
-
-        if M[i].constraints is not None:
-            # evaluate at mode 
-            puq[M[i].cpos] =   np.exp(M[i].cpE[M[i].cpos] + np.sqrt(M[i].cpC[M[i].cpos]) * puq[M[i].cpos])
-            puq[M[i].cneg] = - np.exp(M[i].cpE[M[i].cneg] + np.sqrt(M[i].cpC[M[i].cneg]) * puq[M[i].cneg])
-
-            u[M[i].csel, :] *= puq[M[i].csel] * np.sqrt(M[i].cpC[M[i].csel])[:, None]
-         
-
-        xvp = (xi, vi, puq)
-        xvp = tuple(as_matrix_it(*xvp))
-
-        try: 
-            res = M[i].f(*xvp)
-        except: 
-            raise RuntimeError(f"Error while evaluating model[{i}].f!")
-        f.append(res)
-
-        try: 
-            res = M[i].g(*xvp)
-        except: 
-            raise RuntimeError(f"Error while evaluating model[{i}].g!")
-        g.append(res)
-
-        dfi  = M[i].df(*xvp)
-        d2fi = M[i].d2f(*xvp)
-        dgi  = M[i].dg(*xvp)
-        d2gi = M[i].d2g(*xvp) 
-
-        dfi.dp = dfi.dp @ u
-        dgi.dp = dgi.dp @ u
-
-        d2fi.dx.dp = d2fi.dx.dp @ u
-        d2fi.dv.dp = d2fi.dv.dp @ u
-        d2fi.dv.dx = d2fi.dx.dv.swapaxes(1, 2)
-        d2fi.dp.dx = d2fi.dx.dp.swapaxes(1, 2)
-        d2fi.dp.dv = d2fi.dv.dp.swapaxes(1, 2)
-
-        d2fi.dp.dp = np.einsum('ik,aij,jl->akl', u, d2fi.dp.dp, u)
-
-        d2gi.dx.dp = d2gi.dx.dp @ u
-        d2gi.dv.dp = d2gi.dv.dp @ u
-        d2gi.dv.dx = d2gi.dx.dv.swapaxes(1, 2)
-        d2gi.dp.dx = d2gi.dx.dp.swapaxes(1, 2)
-        d2gi.dp.dv = d2gi.dv.dp.swapaxes(1, 2)
-
-        d2gi.dp.dp = np.einsum('ik,aij,jl->akl', u, d2gi.dp.dp, u)
-
-        dg.append(dgi)
-        df.append(dfi)
-
-        d2f.append(d2fi)
-        d2g.append(d2gi)
+    if pool is not None: 
+        levels = list(pool.map(lambda i: _eval_level(M[i], i, x[i], v[i], qp.p[i], qp.u[i]), range(nl - 1)))
+    else: 
+        levels = [_eval_level(M[i], i, x[i], v[i], qp.p[i], qp.u[i]) for i in range(nl - 1)]
+    f, g, df, d2f, dg, d2g = map(list, zip(*levels))
 
     # Stack f's  and g's
     f = np.concatenate(f).reshape((nx,))
@@ -113,20 +131,20 @@ def dem_eval_err_diff(n: int, d: int, M: HierarchicalGaussianModel, qu: dotdict,
     df = dotdict({k: block_diag(*(dfi[k] for dfi in df)) for k in ['dx', 'dv', 'dp']}) 
 
     # Setup dgdv manually 
-    dgdv = cell(nl, nl-1)
+    # causes (level i) appear at level i in g(x[i],v[i]) and at level i+1 as -I
+    # nb: dg = [dydv[:], dv[0]dv[:], ...]
+    dgdv = np.zeros((ne, nv))
+    ie, iv = 0, 0
     for i in range(nl - 1): 
-        # causes (level i) appear at level i in g(x[i],v[i]) and at level i+1 as -I
-        # nb: dg = [dydv[:], dv[0]dv[:], ...]
-        dgdv[  i, i] = dg[i].dv 
-        dgdv[i+1, i] = -np.eye(M[i].m)
-
-    dgdv = block_matrix(dgdv)
+        if dg[i].dv.size > 0: 
+            dgdv[ie:ie + M[i].l, iv:iv + M[i].m] = dg[i].dv
+        ie += M[i].l
+        np.fill_diagonal(dgdv[ie:ie + M[i].m, iv:iv + M[i].m], -1)
+        iv += M[i].m
 
     # Setup dg
-    dg = dotdict({k: block_diag(*(dgi[k] for dgi in dg)) for k in ['dx', 'dp']}) 
-    # add an extra row to accomodate the highest hierarchical level
-    for k in dg.keys():
-        dg[k] = np.concatenate([dg[k], np.zeros((nc, dg[k].shape[1]))], axis=0)
+    # add an extra (empty) block to accomodate the highest hierarchical level
+    dg = dotdict({k: block_diag(*(dgi[k] for dgi in dg), np.zeros((nc, 0))) for k in ['dx', 'dp']}) 
     dg.dv = dgdv
 
     # Reshape df and dg to avoid errors laters
@@ -137,10 +155,6 @@ def dem_eval_err_diff(n: int, d: int, M: HierarchicalGaussianModel, qu: dotdict,
     dg.dv = dg.dv.reshape((ne, nv))
     dg.dp = dg.dp.reshape((ne, nP))
 
-    # Process d2f, d2g
-    d2f = dotdict({i: dotdict({j: [d2fk[i][j] for d2fk in d2f] for j in ['dx', 'dv', 'dp']}) for i in ['dx', 'dv', 'dp']})
-    d2g = dotdict({i: dotdict({j: [d2gk[i][j] for d2gk in d2g] for j in ['dx', 'dv', 'dp']}) for i in ['dx', 'dv', 'dp']}) 
-
     # Create 2nd order derivative matrices (hierarchical)
     dfdxp = np.zeros((nP, nx, nx))
     dfdvp = np.zeros((nP, nx, nv))
@@ -162,105 +176,72 @@ def dem_eval_err_diff(n: int, d: int, M: HierarchicalGaussianModel, qu: dotdict,
             ie = ie0 + M[i].l
             ip = ip0 + M[i].p 
 
-            dfdxp[ip0:ip, ix0:ix, ix0:ix] = d2f.dp.dx[i].swapaxes(0, 1)
-            dfdvp[ip0:ip, ix0:ix, iv0:iv] = d2f.dp.dv[i].swapaxes(0, 1)
-            dgdxp[ip0:ip, ie0:ie, ix0:ix] = d2g.dp.dx[i].swapaxes(0, 1)
-            dgdvp[ip0:ip, ie0:ie, iv0:iv] = d2g.dp.dv[i].swapaxes(0, 1)
+            dfdxp[ip0:ip, ix0:ix, ix0:ix] = d2f[i].dp.dx.swapaxes(0, 1)
+            dfdvp[ip0:ip, ix0:ix, iv0:iv] = d2f[i].dp.dv.swapaxes(0, 1)
+            dgdxp[ip0:ip, ie0:ie, ix0:ix] = d2g[i].dp.dx.swapaxes(0, 1)
+            dgdvp[ip0:ip, ie0:ie, iv0:iv] = d2g[i].dp.dv.swapaxes(0, 1)
 
             ix0, iv0, ie0, ip0 = ix, iv, ie, ip
 
     dfdpu = np.concatenate([dfdpx, dfdpv], axis=0)
     dgdpu = np.concatenate([dgdpx, dgdpv], axis=0)
 
-    de    = dotdict(
-      dy  = np.eye(ne, ny), 
-      dc  = np.diag(-np.ones(max(ne, nc) - (nc - ne)), nc - ne)[:ne, :nc]
-    )
+    dedy, dedc, dEdy, dEdc, Dx, kn, kd = _dem_err_constants(n, d, ne, nx, ny, nc)
+    de    = dotdict(dy=dedy, dc=dedc)
 
-    # Prediction error (E) - causes        
-    Ev = [np.concatenate([qu.y[0], qu.v[0]]) -  np.concatenate([g, qu.u[0]])]
-    for i in range(1, n):
-        Evi = de.dy @ qu.y[i] + de.dc @ qu.u[i] - dg.dx @ qu.x[i] - dg.dv @ qu.v[i]
-        Ev.append(Evi)
+    # Prediction error (E), written through views of shape (n, ne) and (n, nx), 
+    # with all orders i >= 1 at once
+    E  = np.empty((n*(ne + nx), 1))
+    Ev = E[:n*ne].reshape((n, ne))
+    Ex = E[n*ne:].reshape((n, nx))
 
-    # Prediction error (E) - states
-    Ex = [qu.x[1] - f]
-    for i in range(1, n-1):
-        Exi = qu.x[i + 1] - df.dx @ qu.x[i] - df.dv @ qu.v[i]
-        Ex.append(Exi)
-    Ex.append(np.zeros_like(Exi))
+    # causes
+    Ev[0]  = np.concatenate([qu.y[0], qu.v[0]]) -  np.concatenate([g, qu.u[0]])
+    Ev[1:] = qu.y[1:] @ de.dy.T + qu.u[1:] @ de.dc.T - qu.x[1:] @ dg.dx.T - qu.v[1:] @ dg.dv.T
 
-    Ev = np.concatenate(Ev)
-    Ex = np.concatenate(Ex)
-    E  = np.concatenate([Ev, Ex])[:, None]
+    # states
+    Ex[0]     = qu.x[1] - f
+    Ex[1:n-1] = qu.x[2:] - qu.x[1:n-1] @ df.dx.T - qu.v[1:n-1] @ df.dv.T
+    Ex[n-1]   = 0
 
     # generalised derivatives
-    dgdp = [dg.dp]
-    dfdp = [df.dp]
-
-    qux = qu.x[..., None]
-    quv = qu.v[..., None]
-    for i in range(1, n):
-        dgdpi = dg.dp.copy()
-        dfdpi = df.dp.copy()
-
-        for ip in range(nP): 
-            dgdpi[:, ip] = (dgdxp[ip] @ qux[i] + dgdvp[ip] @ quv[i]).squeeze(1)
-            dfdpi[:, ip] = (dfdxp[ip] @ qux[i] + dfdvp[ip] @ quv[i]).squeeze(1)
-        
-        dfdp.append(dfdpi)
-        dgdp.append(dgdpi)
-
-    df.dp = np.concatenate(dfdp)
-    dg.dp = np.concatenate(dgdp)
-
-    de.dy               = kron_eye(de.dy, n)
-    df.dy               = np.zeros((n*nx, n*ny))# kron(np.eye(n, n), np.zeros((nx, ny)))
-    df.dc               = np.zeros((n*nx, n*nc))
-    dg.dx               = kron_eye(dg.dx, n)
-    # df.dx = (I * df.dx) - D, Eq. 45
-    df.dx               = kron_eye(df.dx, n) - kron(np.diag(np.ones(n - 1), 1), np.eye(nx, nx)) 
+    # d[g,f]dp[i][:, ip] = d[g,f]dxp[ip] @ qu.x[i] + d[g,f]dvp[ip] @ qu.v[i], for all i >= 1 at once
+    dgdp  = np.tensordot(qu.x[1:], dgdxp, axes=([1], [2])) + np.tensordot(qu.v[1:], dgdvp, axes=([1], [2]))
+    dfdp  = np.tensordot(qu.x[1:], dfdxp, axes=([1], [2])) + np.tensordot(qu.v[1:], dfdvp, axes=([1], [2]))
 
-    # embed to n >= d
-    dedc                = np.zeros((n*ne, n*nc)) 
-    dedc[:n*ne,:d*nc]   = kron_eye(de.dc, n, d) # kron(np.eye(n, d), 
-    de.dc               = dedc
+    df.dp = np.concatenate([df.dp, dfdp.transpose((0, 2, 1)).reshape(((n - 1) * nx, nP))])
+    dg.dp = np.concatenate([dg.dp, dgdp.transpose((0, 2, 1)).reshape(((n - 1) * ne, nP))])
 
-    dgdv                = np.zeros((n*ne, n*nv))
-    dgdv[:n*ne,:d*nv]   = kron_eye(dg.dv, n, d)# kron(np.eye(n, d), dg.dv)
-    dg.dv               = dgdv
-
-    dfdv                = np.zeros((n*nx, n*nv))
-    dfdv[:n*nx,:d*nv]   = kron_eye(df.dv, n, d)#kron(np.eye(n, d), df.dv)
-    df.dv               = dfdv
+    # generalised derivatives (kronecker products with identity) are written 
+    # in place into the blocks of dE.du, dE.dup and dE.dpu, through views of 
+    # shape (..., n, m, n, k) on the rows [e, x] and columns [x, v]
+    ie = slice(0, n*ne)
+    ix = slice(n*ne, n*(ne + nx))
+    ju = slice(0, n*nx)
+    jv = slice(n*nx, n*(nx + nv))
 
     dE    = dotdict()
-    dE.dy = np.concatenate([de.dy, df.dy])
-    dE.dc = np.concatenate([de.dc, df.dc])
+    dE.dy = dEdy
+    dE.dc = dEdc
     dE.dp = - np.concatenate([dg.dp, df.dp])
-    dE.du = - block_matrix([
-            [dg.dx, dg.dv], 
-            [df.dx, df.dv]])
-
-    dE.dup = []
-    for ip in range(nP): 
-        dfdxpi              = kron_eye(dfdxp[ip], n) # kron(np.eye(n,n), dfdxp[ip])
-        dgdxpi              = kron_eye(dgdxp[ip], n) # kron(np.eye(n,n), dgdxp[ip])
-        dfdvpi              = np.zeros((n*nx, n*nv))
-        dfdvpi[:,:d*nv]     = kron_eye(dfdvp[ip], n, d) # kron(np.eye(n,d), dfdvp[ip])
-        dgdvpi              = np.zeros((n*ne, n*nv))
-        dgdvpi[:,:d*nv]     = kron_eye(dgdvp[ip], n, d) # kron(np.eye(n,d), dgdvp[ip])
-
-        dEdupi = -block_matrix([[dgdxpi, dgdvpi], [dfdxpi, dfdvpi]])
-        dE.dup.append(dEdupi)
-
-    dE.dpu = [] 
-    for i in range(n): 
-        for iu in range(nx + nv):
-            dfdpui = kron_eye(dfdpu[iu], n, 1) # kron(np.eye(n,1), dfdpu[iu])
-            dgdpui = kron_eye(dgdpu[iu], n, 1) # kron(np.eye(n,1), dgdpu[iu])
-            dEdpui = np.concatenate([dgdpui, dfdpui], axis=0)
-
-            dE.dpu.append(dEdpui)
+
+    dE.du = np.zeros((n*(ne + nx), n*(nx + nv)))
+    dE.du[ie, ju].reshape((n, ne, n, nx))[kn, :, kn, :] = - dg.dx   # kron(np.eye(n,n), dg.dx)
+    dE.du[ie, jv].reshape((n, ne, n, nv))[kd, :, kd, :] = - dg.dv   # kron(np.eye(n,d), dg.dv)
+    dE.du[ix, ju].reshape((n, nx, n, nx))[kn, :, kn, :] = - df.dx   # kron(np.eye(n,n), df.dx)
+    dE.du[ix, jv].reshape((n, nx, n, nv))[kd, :, kd, :] = - df.dv   # kron(np.eye(n,d), df.dv)
+    dE.du[ix, ju]      += Dx
+
+    dE.dup = np.zeros((nP, n*(ne + nx), n*(nx + nv)))
+    dE.dup[:, ie, ju].reshape((nP, n, ne, n, nx))[:, kn, :, kn, :] = - dgdxp
+    dE.dup[:, ie, jv].reshape((nP, n, ne, n, nv))[:, kd, :, kd, :] = - dgdvp
+    dE.dup[:, ix, ju].reshape((nP, n, nx, n, nx))[:, kn, :, kn, :] = - dfdxp
+    dE.dup[:, ix, jv].reshape((nP, n, nx, n, nv))[:, kd, :, kd, :] = - dfdvp
+
+    # kron(np.eye(n,1), dfdpu[iu]), identical for each order i 
+    dE.dpu = np.zeros((n, nx + nv, n*(ne + nx), nP))
+    dE.dpu[:, :, :ne]               = dgdpu
+    dE.dpu[:, :, n*ne:n*ne + nx]    = dfdpu
+    dE.dpu = dE.dpu.reshape((n*(nx + nv), n*(ne + nx), nP))
 
     return E, dE
\ No newline at end of file
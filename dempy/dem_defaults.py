@@ -6,4 +6,8 @@ import numpy as np
 dem_defaults = dotdict() 
 
 dem_defaults.symengine = dotdict()
-dem_defaults.symengine.lambdify = dotdict(backend='llvm', cse=True, dtype=np.float64)
\ No newline at end of file
+dem_defaults.symengine.lambdify = dotdict(backend='llvm', cse=True, dtype=np.float64)
+
+# directory of the on-disk cache of compiled symbolic derivatives, e.g. ~/.cache/dempy (None, the default, disables it). 
+# Entries are unpickled when loaded, so it must be trusted (and not shared between hosts with different cpus)
+dem_defaults.symengine.cache_dir = None
\ No newline at end of file
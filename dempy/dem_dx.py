@@ -22,15 +22,48 @@ def compute_dx(f, dfdx, t, isreg=False):
         return np.array([[]])
 
     # use the exponentiation trick to avoid inverting dfdx
-    J  = block_matrix([
-        [np.zeros((1,1)),       []], 
-        [          f * t, dfdx * t]
-    ])
+    n  = f.shape[0]
+    J  = np.zeros((n + 1, n + 1))
+    np.multiply(f, t, out=J[1:, :1])
+    np.multiply(dfdx, t, out=J[1:, 1:])
     dx = matrix_exp(J)
 
     return dx[1:, 0, None]
 
 
+def compute_dx_nilpotent(f, dfdx, t, m, order): 
+    # Same as compute_dx, for dfdx = [[A, B], [0, C]] whose last m rows and columns
+    # C are nilpotent, with C^order = 0 (e.g. derivative operators on exogenous states). 
+    # The bottom states z are then polynomials in time, z(s) = sum_j s^j / j! C^(j-1) f2, 
+    # so that the top states are the response of A to a polynomial input, obtained by 
+    # exponentiating A augmented with a chain of integrators h_j' = h_(j-1) (h_j(s) = s^j/j!), 
+    # which is of size len(A) + order + 1 instead of len(dfdx) + 1. 
 
+    if len(f.shape) == 1: 
+        f = f[..., None]
+
+    if f.shape[0] != dfdx.shape[0]: 
+        raise ValueError(f'Shape mismatch: first dim of f {f.shape} must match that of df/dx {dfdx.shape}.')
 
+    n  = f.shape[0] - m
+    B  = dfdx[:n, n:] * t
+    C  = dfdx[n:, n:] * t
+    c  = f[n:] * t
+
+    # augmented matrix on (x, h_order, ..., h_1, h_0)
+    J  = np.zeros((n + order + 1, n + order + 1))
+    np.multiply(dfdx[:n, :n], t, out=J[:n, :n])
+    np.multiply(f[:n, 0], t, out=J[:n, -1])
+
+    dz = np.zeros((m, 1))
+    jf = 1.
+    for j in range(1, order + 1): 
+        jf               = jf * j
+        dz               = dz + c / jf                  # z(1) 
+        J[:n, -1 - j]    = (B @ c)[:, 0]                # input of x from h_j
+        J[-1 - j, -j]    = 1                            # h_j' = h_(j-1)
+        c                = C @ c
+
+    dx = matrix_exp(J)
 
+    return np.concatenate([dx[:n, -1, None], dz])
\ No newline at end of file
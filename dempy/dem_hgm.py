@@ -1,62 +1,174 @@
 import numpy as np
 import warnings
 import time
+from typing import Callable, List
 
 from .dem_structs import *
 from .dem_dx import *
 from .dem_symb import *
+from .dem_num import *
 from .utils import *
 
 
+# shared output of the default (static) f, and its empty states (neither is ever written to, as they are empty)
+_EMPTY_COL = np.zeros((0,1))
+
+# read-only placeholders for unspecified fields (only their size and shape are read)
+_EMPTY_1D = np.empty(0)
+_EMPTY_2D = np.empty((0,0))
+_EMPTY_1D.setflags(write=False)
+_EMPTY_2D.setflags(write=False)
+
+def _zero_f(*args): 
+    return _EMPTY_COL
+
+# codes of parameter constraints
+_UNCONSTRAINED = 0
+_POSITIVE      = 1
+_NEGATIVE      = 2
+
+def _encode_constraints(constraints): 
+    # constraints as int8 codes, from labels ('positive', 'negative', anything else is unconstrained) or codes
+    constraints = np.asarray(constraints)
+    if constraints.dtype.kind in 'biu': 
+        return constraints.astype(np.int8, copy=False)
+    return np.select([constraints == 'positive', constraints == 'negative'], [_POSITIVE, _NEGATIVE], _UNCONSTRAINED).astype(np.int8)
+
+def _scaled_eye(n: int, s): 
+    # s * np.eye(n), without allocating the identity (s is a scalar or the n diagonal values, 
+    # as np.fill_diagonal would silently cycle through values of any other size)
+    if np.size(s) != 1 and np.size(s) != n: 
+        raise ValueError(f'Cannot scale eye({n}) by values of size {np.size(s)}.')
+    out = np.zeros((n, n))
+    np.fill_diagonal(out, s)
+    return out
+
+def _check_components(Q, hE, hC, k: int, pP: float, i: int, *names): 
+    # precision components Q (k x k), and prior expectation hE and covariance hC of their log-precisions, 
+    # for model[i] (names of the fields are used in messages)
+    nQ, nE, nC = names
+
+    Q  = [] if Q is None else Q
+    nq = len(Q)
+
+    # check hyperpriors (expectation)
+    hE = np.zeros((nq, 1)) if hE is None else np.array(hE).reshape((-1,1))
+    ne = hE.size
+
+    #  check hyperpriors (covariances)
+    if hC is not None: 
+        hC = np.array(hC).reshape((-1,1))
+
+        # (column vectors) hC must broadcast with hE
+        if hC.size != ne and hC.size != 1 and ne != 1: 
+            warnings.warn(f'M[{i}].{nC} does not broadcast with M[{i}].{nE}. Setting M[{i}].{nC} to identity.')
+            hC = None
+
+    if hC is None: 
+        hC = _scaled_eye(ne, 1 / pP)
+
+    # check components and assume iid if not specified
+    if nq > ne: 
+        hE = np.zeros((nq, 1)) + hE[0]
+    elif nq < ne: 
+        Q  = [np.eye(k)]
+        hE = hE[0].reshape((1,1))
+    ne = nq = len(Q)
+
+    nc = hC.size
+    if ne == nc: 
+        hC = np.diag(hC.flat)
+    elif ne > nc: 
+        hC = _scaled_eye(nq, hC[0])
+
+    # check consistency and sizes
+    for j, Qj in enumerate(Q):
+        if len(Qj) != k: 
+            raise ValueError(f"Wrong shape for model[{i}].{nQ}[{j}]"
+                             f"(expected ({k},{k}), got {Qj.shape})")
+
+    return Q, hE, hC
+
+def _check_fixed_precision(V, k: int, hE, i: int, name: str): 
+    # fixed precision V (k x k) of model[i], which is the identity if unspecified and there are no components
+    V = _EMPTY_1D if V is None else V
+
+    if len(V.shape) == 1 and len(V) == k: 
+        V = np.diag(V)
+    elif len(V) != k and len(V) > 0 and np.size(V[0]) in (1, k): 
+        # V[0] scales the identity (as a scalar or its diagonal values)
+        V = _scaled_eye(k, V[0])
+    elif len(V) != k: 
+        if len(V) > 0: 
+            warnings.warn(f'Failed to compute eye({k}) * M[{i}].{name}[0].')
+
+        V = np.eye(k) if len(hE) == 0 else np.zeros((k, k))
+
+    return V
+
 class GaussianModel(dotdict): 
-    def __init__(self, 
-        f=None, g=None, fsymb=None, gsymb=None, m=None, n=None, l=None, p=None, x=None, v=None, 
-        pE=None, pC=None, hE=None, hC=None, gE=None, gC=None, Q=None, R=None, V=None, W=None, xP=None, vP=None, sv=None, sw=None,
-         constraints=None, delays=None, delays_idxs=None, df=None, d2f=None, dg=None, d2g=None): 
-        self.f  : Callable         = f  # forward function (must be numpy compatible) - takes 3 vector arguments, return 1 vector of size n
-        self.g  : Callable         = g  # observation function (must be numpy compatible) - takes 3 vector arguments, return 1 vector of size l
+    __slots__ = ()
+
+    # fields (only the given ones are stored, the others read as None)
+    f  : Callable               # forward function (must be numpy compatible) - takes 3 vector arguments, return 1 vector of size n
+    g  : Callable               # observation function (must be numpy compatible) - takes 3 vector arguments, return 1 vector of size l
 
-        self.fsymb: Callable       = fsymb # symbolic declaration of f using sympy
-        self.gsymb: Callable       = gsymb # symbolic declaration of g using sympy
+    fsymb: Callable             # symbolic declaration of f using sympy
+    gsymb: Callable             # symbolic declaration of g using sympy
 
-        self.m  : int              = m  # number of inputs
-        self.n  : int              = n  # number of states
-        self.l  : int              = l  # number of outputs
-        self.p  : int              = p  # number of parameters
+    m  : int                    # number of inputs
+    n  : int                    # number of states
+    l  : int                    # number of outputs
+    p  : int                    # number of parameters
 
-        self.x  : np.ndarray       = x  # explicitly specified states
-        self.v  : np.ndarray       = v  # explicitly specified inputs
+    x  : np.ndarray             # explicitly specified states
+    v  : np.ndarray             # explicitly specified inputs
 
-        self.pE : np.ndarray       = pE # prior expectation of parameters p
-        self.pC : np.ndarray       = pC # prior covariance of parameters p
-        self.hE : np.ndarray       = hE # prior expectation of hyperparameters h (log-precision of cause noise)
-        self.hC : np.ndarray       = hC # prior covariance of hyperparameters h (log-precision of cause noise)
-        self.gE : np.ndarray       = gE # prior expectation of hyperparameters g (log-precision of state noise)
-        self.gC : np.ndarray       = gC # prior covariance of hyperparameters g (log-precision of state noise)
+    pE : np.ndarray             # prior expectation of parameters p
+    pC : np.ndarray             # prior covariance of parameters p
+    hE : np.ndarray             # prior expectation of hyperparameters h (log-precision of cause noise)
+    hC : np.ndarray             # prior covariance of hyperparameters h (log-precision of cause noise)
+    gE : np.ndarray             # prior expectation of hyperparameters g (log-precision of state noise)
+    gC : np.ndarray             # prior covariance of hyperparameters g (log-precision of state noise)
 
-        self.Q  : List[np.ndarray] = Q  # precision components (input noise)
-        self.R  : List[np.ndarray] = R  # precision components (state noise)
-        self.V  : np.ndarray       = V  # fixed precision (input noise)
-        self.W  : np.ndarray       = W  # fixed precision (state noise)
-        self.xP : np.ndarray       = xP # precision (states)
-        self.vP : np.ndarray       = vP # precision (inputs)
+    Q  : List[np.ndarray]       # precision components (input noise)
+    R  : List[np.ndarray]       # precision components (state noise)
+    V  : np.ndarray             # fixed precision (input noise)
+    W  : np.ndarray             # fixed precision (state noise)
+    xP : np.ndarray             # precision (states)
+    vP : np.ndarray             # precision (inputs)
 
-        self.constraints: np.ndarray = constraints
+    constraints: np.ndarray     # 'positive', 'negative' or anything else (unconstrained), stored as int8 codes
 
-        self.sv : np.ndarray       = sv # smoothness (input noise)
-        self.sw : np.ndarray       = sw # smoothness (state noise)
+    sv : np.ndarray             # smoothness (input noise)
+    sw : np.ndarray             # smoothness (state noise)
 
-        self.df  :    cdotdict     = df
-        self.d2f :    cdotdict     = d2f
-        self.dg  :    cdotdict     = dg
-        self.d2g :    cdotdict     = d2g
+    df  :    cdotdict     
+    d2f :    cdotdict     
+    dg  :    cdotdict     
+    d2g :    cdotdict     
 
-        # if not none, contains the function to compute the delay matrix or the delay matrix itself, which must broadcast to the system jacobian
-        self.delays                = delays 
-        self.delays_idxs           = delays_idxs
+    # if not none, contains the function to compute the delay matrix or the delay matrix itself, which must broadcast to the system jacobian
+    delays      : object
+    delays_idxs : object
+
+    def __init__(self, 
+        f=None, g=None, fsymb=None, gsymb=None, m=None, n=None, l=None, p=None, x=None, v=None, 
+        pE=None, pC=None, hE=None, hC=None, gE=None, gC=None, Q=None, R=None, V=None, W=None, xP=None, vP=None, sv=None, sw=None,
+         constraints=None, delays=None, delays_idxs=None, df=None, d2f=None, dg=None, d2g=None): 
+        if constraints is not None: 
+            constraints = _encode_constraints(constraints)
+        super().__init__((k, v) for k, v in locals().items() if v is not None and k != 'self' and k != '__class__')
+
+    def __missing__(self, key): 
+        # unset fields read as None
+        if key in GaussianModel.__annotations__: 
+            return None
+        raise KeyError(key)
 
     def copy(self):
-        o = GaussianModel()
+        # all fields are overwritten, so we skip __init__
+        o = GaussianModel.__new__(GaussianModel)
 
         o.update(self)
 
@@ -84,16 +196,17 @@ class GaussianModel(dotdict):
         if o.delays is not None:
             try: 
                 o.delays = np.array(delays, copy=True)
-            except:
+            except Exception: 
                 pass
 
         return o
 
 class HierarchicalGaussianModel(list): 
-    def __init__(self, *models: GaussianModel, dt=None, use_numerical_derivatives=False, n_jobs=1, prepare=True): 
+    def __init__(self, *models: GaussianModel, dt=None, use_numerical_derivatives=False, n_jobs=1, prepare=True, validate=True): 
         self.dt = 1 if dt is None else dt 
         self._use_numerical_derivatives = use_numerical_derivatives
         self._n_jobs   = n_jobs
+        self._validate = validate # if False, f and g are not called to check their outputs (declared l's are used)
         self._prepared = False
 
         if prepare: 
@@ -101,13 +214,23 @@ class HierarchicalGaussianModel(list):
 
         super().__init__(models)
 
+        if not prepare: 
+            self._index_levels(self)
+
     def copy(self): 
         c = [m.copy() for m in self]
         o = HierarchicalGaussianModel(*c, dt=self.dt, use_numerical_derivatives=self._use_numerical_derivatives, 
-                    n_jobs=self._n_jobs, prepare=False)
+                    n_jobs=self._n_jobs, prepare=False, validate=self._validate)
 
         return o
 
+    def _index_levels(self, M): 
+        # dimensions of all levels, as contiguous arrays (struct-of-arrays), fixed once the levels are prepared
+        # (p is not included, as DEM overrides it with the number of singular values of pC)
+        self.ns = np.array([m.n for m in M], dtype=np.int64) # number of states
+        self.ms = np.array([m.m for m in M], dtype=np.int64) # number of inputs
+        self.ls = np.array([m.l for m in M], dtype=np.int64) # number of outputs
+
     def prepare_models(self, *models):
         # inspired from spm_DEM_set by Karl Friston
 
@@ -125,73 +248,78 @@ class HierarchicalGaussianModel(list):
         M[-1].p = 0
 
         for i in range(g): 
+            Mi = M[i]
+
             # check for hidden states
-            if M[i].f is not None and M[i].n is None and M[i].x is None:
+            if Mi.f is not None and Mi.n is None and Mi.x is None:
                 raise ValueError('please specify hidden states or their number')
 
             # default fields for static models (hidden states)
-            if not callable(M[i].f) and not callable(M[i].fsymb): 
-                M[i].f = lambda *x: np.zeros((0,1))
-                M[i].x = np.zeros((0,1))
-                M[i].n = 0
+            if not callable(Mi.f) and not callable(Mi.fsymb): 
+                Mi.f = _zero_f
+                Mi.x = _EMPTY_COL
+                Mi.n = 0
 
             # consistency and format check on states, parameters and functions
             # ================================================================
 
             # prior expectation of parameters pE
             # ----------------------------------
-            if   M[i].pE is None: 
-                 M[i].pE = np.zeros((0,1))
-            elif len(M[i].pE.shape) == 1: 
-                 M[i].pE = M[i].pE[..., None]
+            if   Mi.pE is None: 
+                 Mi.pE = np.zeros((0,1))
+            elif len(Mi.pE.shape) == 1: 
+                 Mi.pE = Mi.pE[..., None]
 
-            p       = M[i].pE.shape[0]
-            M[i].p  = p
-            M[i].nP = p # store the original number of params, p will be overidden by the number of singular values
+            p       = Mi.pE.shape[0]
+            Mi.p  = p
+            Mi.nP = p # store the original number of params, p will be overidden by the number of singular values
 
             # and prior covariances pC
-            if  M[i].pC is None:
-                M[i].pC = np.zeros((p, p))
+            if  Mi.pC is None:
+                Mi.pC = np.zeros((p, p))
 
             # convert variance to covariance
-            elif not hasattr(M[i].pC, 'shape') or len(M[i].pC.shape) == 0:  
-                M[i].pC = np.eye(p) * M[i].pC
+            elif not hasattr(Mi.pC, 'shape') or len(Mi.pC.shape) == 0:  
+                Mi.pC = _scaled_eye(p, Mi.pC)
 
             # convert variances to covariance
-            elif len(M[i].pC.shape) == 1: 
-                M[i].pC = np.diag(M[i].pC)
+            elif len(Mi.pC.shape) == 1: 
+                Mi.pC = np.diag(Mi.pC)
 
             # check size
-            if M[i].pC.shape[0] != p or M[i].pC.shape[1] != p: 
-                raise ValueError(f'Wrong shape for model[{i}].pC: expected ({p},{p}) but got {M[i].pC.shape}.')
+            if Mi.pC.shape[0] != p or Mi.pC.shape[1] != p: 
+                raise ValueError(f'Wrong shape for model[{i}].pC: expected ({p},{p}) but got {Mi.pC.shape}.')
 
             # expectations and covariances of constrained parameters
             # ------------------------------------------------------
-            if M[i].constraints is not None: 
-                if M[i].constraints.size != M[i].p: 
-                    raise ValueError(f'The size of constraints ({M[i].constraints.size} '
-                        f'does not match that of parameter expectations ({M[i].p}).')
+            if Mi.constraints is not None: 
+                Mi.constraints = _encode_constraints(Mi.constraints)
+                if Mi.constraints.size != Mi.p: 
+                    raise ValueError(f'The size of constraints ({Mi.constraints.size} '
+                        f'does not match that of parameter expectations ({Mi.p}).')
                 else: 
-                    M[i].cpos = M[i].constraints == 'positive'
-                    M[i].cneg = M[i].constraints == 'negative'
-                    M[i].csel = np.logical_or(M[i].cpos, M[i].cneg)
+                    pos = Mi.cpos = Mi.constraints == _POSITIVE
+                    neg = Mi.cneg = Mi.constraints == _NEGATIVE
+                    sel = Mi.csel = np.logical_or(pos, neg)
+
+                    pE  = Mi.pE[:, 0]
 
                     # reparameterization as lognormal 
-                    M[i].cpE  = M[i].pE.copy()
+                    Mi.cpE  = Mi.pE.copy()
 
                     # pE parameter in mean in log (natural) space 
-                    M[i].cpE[M[i].cpos] = np.log(1e-16 + M[i].pE.squeeze()[M[i].cpos] / np.sqrt(1 + np.diag(M[i].pC[M[i].cpos]) / (M[i].pE.squeeze()[M[i].cpos])**2))
-                    M[i].cpE[M[i].cneg] = np.log(1e-16 - M[i].pE.squeeze()[M[i].cneg] / np.sqrt(1 + np.diag(M[i].pC[M[i].cneg]) / (M[i].pE.squeeze()[M[i].cneg])**2))
+                    Mi.cpE[pos] = np.log(1e-16 + pE[pos] / np.sqrt(1 + np.diag(Mi.pC[pos]) / pE[pos]**2))
+                    Mi.cpE[neg] = np.log(1e-16 - pE[neg] / np.sqrt(1 + np.diag(Mi.pC[neg]) / pE[neg]**2))
                     
-                    M[i].cpC  = np.diag(M[i].pC).copy()
-                    M[i].cpC[M[i].csel] = np.log(1 + np.diag(M[i].pC)[M[i].csel] / (M[i].pE.squeeze()[M[i].csel])**2)
+                    Mi.cpC  = np.diag(Mi.pC).copy()
+                    Mi.cpC[sel] = np.log1p(Mi.cpC[sel] / pE[sel]**2)
 
-                    M[i].pE[M[i].csel] = 0
-                    M[i].pC.flat[np.outer(M[i].csel, M[i].csel).reshape((-1,))] = 1
+                    Mi.pE[sel] = 0
+                    Mi.pC[np.ix_(sel, sel)] = 1
 
         # get inputs
-        v = np.zeros((0,0)) if M[-1].v is None else M[-1].v.reshape(-1, 1)
-        if prod(v.shape) == 0:
+        v = _EMPTY_2D if M[-1].v is None else M[-1].v.reshape(-1, 1)
+        if v.size == 0:
             if M[-2].m is not None: 
                 v = np.zeros((M[-2].m, 1))
 
@@ -204,134 +332,168 @@ class HierarchicalGaussianModel(list):
 
         # check functions
         for i in reversed(range(g - 1)):
+            Mi = M[i]
 
             # prepare states
-            x = np.zeros((M[i].n, 1)) if M[i].x is None else M[i].x.reshape(-1, 1)
+            x = np.zeros((Mi.n, 1)) if Mi.x is None else Mi.x.reshape(-1, 1)
 
-            if prod(x.shape) == 0 and M[i].n > 0:
-                x = np.zeros((M[i].n, 1))
+            if x.size == 0 and Mi.n > 0:
+                x = np.zeros((Mi.n, 1))
 
             # prepare input dims
-            if M[i].m is not None and M[i].m != v.shape[0]:
-                warnings.warn(f'Declared input shape of model {i} ({M[i].m}) '
+            if Mi.m is not None and Mi.m != v.shape[0]:
+                warnings.warn(f'Declared input shape of model {i} ({Mi.m}) '
                     f'does not match output shape of model[{i+1}].g ({v.shape[0]})!')
 
-            M[i].m = v.shape[0]
+            Mi.m = v.shape[0]
             
             # check f function
-            if callable(M[i].f) and callable(M[i].fsymb): 
+            if callable(Mi.f) and callable(Mi.fsymb): 
                 raise ValueError(f"Got bot 'f' and 'fsymb' functions for model[{i}]!")
 
-            if callable(M[i].fsymb):
-                if M[i].delays is None:
-                    M[i].f = compile_symb_func(M[i].fsymb, M[i].n, M[i].m, M[i].p, input_keys='xvp')
+            if callable(Mi.fsymb):
+                if Mi.delays is None:
+                    Mi.f = compile_symb_func(Mi.fsymb, Mi.n, Mi.m, Mi.p, input_keys='xvp')
                 else:
-                    M[i].f = compile_symb_func_delays(M[i].fsymb, M[i].n, M[i].m, M[i].p, delays=M[i].delays, delays_idxs=M[i].delays_idxs, input_keys='xvp')
+                    Mi.f = compile_symb_func_delays(Mi.fsymb, Mi.n, Mi.m, Mi.p, delays=Mi.delays, delays_idxs=Mi.delays_idxs, input_keys='xvp')
 
             # check function f(x, v, P)
-            elif not callable(M[i].f): 
+            elif not callable(Mi.f): 
                 raise ValueError(f"Not callable function: model[{i}].f!")
             
-            try: 
-                f = M[i].f(x, v, M[i].pE)
-            except: 
-                raise ValueError(f"Error while calling function: model[{i}].f")
+            if self._validate: 
+                try: 
+                    f = Mi.f(x, v, Mi.pE)
+                except Exception as e: 
+                    raise ValueError(f"Error while calling function: model[{i}].f") from e
 
-            if f.shape != x.shape:
-                raise ValueError(f"Wrong shape for output of model[{i}].f (expected {x.shape}, got {f.shape}).")
+                if f.shape != x.shape:
+                    raise ValueError(f"Wrong shape for output of model[{i}].f (expected {x.shape}, got {f.shape}).")
 
             # check g function
-            if callable(M[i].g) and callable(M[i].gsymb): 
+            if callable(Mi.g) and callable(Mi.gsymb): 
                 raise ValueError(f"Got bot 'g' and 'gsymb' functions for model[{i}]!")
 
-            if callable(M[i].gsymb):
-                M[i].g = compile_symb_func(M[i].gsymb, M[i].n, M[i].m, M[i].p, input_keys='xvp')
+            if callable(Mi.gsymb):
+                Mi.g = compile_symb_func(Mi.gsymb, Mi.n, Mi.m, Mi.p, input_keys='xvp')
 
             # check function g(x, v, P)
-            elif not callable(M[i].g): 
+            elif not callable(Mi.g): 
                 raise ValueError(f"Not callable function for model[{i}].g!")
 
-            try: 
-                v = M[i].g(x, v, M[i].pE)
-            except: 
-                raise ValueError(f"Error while calling function: model[{i}].g")
-            if M[i].l is not None and M[i].l != v.shape[0]:
-                warnings.warn(f'Declared output shape of model {i} ({M[i].l}) '
+            if self._validate or Mi.l is None: 
+                try: 
+                    v = Mi.g(x, v, Mi.pE)
+                except Exception as e: 
+                    raise ValueError(f"Error while calling function: model[{i}].g") from e
+            else: 
+                # trust the declared number of outputs
+                v = np.zeros((Mi.l, 1))
+            if Mi.l is not None and Mi.l != v.shape[0]:
+                warnings.warn(f'Declared output shape of model {i} ({Mi.l}) '
                     f'does not match output of model[{i}].g ({v.shape[0]})!')
 
-            M[i].l = v.shape[0]
-            M[i].n = x.shape[0]
-
-            M[i].v = v
-            M[i].x = x
-
-            print('Compiling derivatives, it might take some time... ')
-
-            if M[i].df is None and M[i].d2f is None: 
-                print('  Compiling f... ', end='')
-                ffunc = M[i].fsymb if M[i].fsymb is not None else M[i].f
-                        
-                start_time = time.time()
+            Mi.l = v.shape[0]
+            Mi.n = x.shape[0]
+
+            Mi.v = v
+            Mi.x = x
+
+        # compute derivatives
+        # ===================
+        # symbolic derivatives of all levels are collected and obtained at once, such that the ones 
+        # that are not cached yet can be compiled in parallel (in self._n_jobs processes, which requires 
+        # scripts to use a main guard on spawn platforms, see compute_sym_df_d2f_many). Numerical 
+        # derivatives skip the symbolic pipeline (fsymb and gsymb are only compiled for complex inputs)
+        symb   = []
+        delays = []
+        for i in range(g - 1): 
+            Mi = M[i]
+            if Mi.df is None and Mi.d2f is None: 
                 try:
-                    if M[i].delays is None: 
-                        M[i].df, M[i].d2f = compute_sym_df_d2f(ffunc, M[i].n, M[i].m, M[i].p, input_keys='xvp')
+                    if Mi.delays is None and self._use_numerical_derivatives: 
+                        ffunc = Mi.f if Mi.fsymb is None else compile_symb_func(Mi.fsymb, Mi.n, Mi.m, Mi.p, input_keys='xvp', real=False)
+                        Mi.df, Mi.d2f = compute_num_df_d2f(ffunc, Mi.n, Mi.m, Mi.p, input_keys='xvp')
+                    elif Mi.delays is None: 
+                        symb.append((i, 'f', Mi.f if Mi.fsymb is None else Mi.fsymb))
                     else: 
-                        M[i].df, M[i].d2f = compute_sym_df_d2f_delays(ffunc, M[i].n, M[i].m, M[i].p, delays=M[i].delays, delays_idxs=M[i].delays_idxs, input_keys='xvp')
-                except Exception: 
-                    raise RuntimeError(f'Failed to obtain analytical derivatives for M[{i}].f.')
-                print(f'f() ok. (compiled in {(time.time() - start_time):.2f}s)')
+                        delays.append(i)
+                except Exception as e: 
+                    raise RuntimeError(f'Failed to obtain numerical derivatives for M[{i}].f.') from e
 
-            elif M[i].df is not None and M[i].d2f is not None:
+            elif Mi.df is not None and Mi.d2f is not None:
                 pass
                 # ... todo: check and stuff
             else: raise ValueError('Either both of (or none of) df, d2f must be provided')
 
-
             # compute g-derivatives in the general case
-            if M[i].dg is None and M[i].d2g is None: 
-                print('  Compiling g... ', end='')
-                gfunc = M[i].gsymb if M[i].gsymb is not None else M[i].g
+            if Mi.dg is None and Mi.d2g is None: 
                 try:
-                    start_time = time.time()
-                    M[i].dg, M[i].d2g = compute_sym_df_d2f(gfunc, M[i].n, M[i].m, M[i].p, input_keys='xvp')
-                    print(f'g() ok. (compiled in {(time.time() - start_time):.2f}s)')
-
-                except Exception: 
-                    raise RuntimeError(f'Failed to obtain analytical derivatives for M[{i}].g.')
+                    if self._use_numerical_derivatives: 
+                        gfunc = Mi.g if Mi.gsymb is None else compile_symb_func(Mi.gsymb, Mi.n, Mi.m, Mi.p, input_keys='xvp', real=False)
+                        Mi.dg, Mi.d2g = compute_num_df_d2f(gfunc, Mi.n, Mi.m, Mi.p, input_keys='xvp')
+                    else: 
+                        symb.append((i, 'g', Mi.g if Mi.gsymb is None else Mi.gsymb))
+                except Exception as e: 
+                    raise RuntimeError(f'Failed to obtain numerical derivatives for M[{i}].g.') from e
 
-            elif M[i].dg is not None and M[i].d2g is not None:
+            elif Mi.dg is not None and Mi.d2g is not None:
                 pass
                 # ... todo: check and stuff
             else: raise ValueError('Either both of (or none of) dg, d2g must be provided')
 
-            print('Done. ')
+        if symb or delays: 
+            print('Compiling derivatives, it might take some time... ')
+            start_time = time.time()
+
+            for i in delays: 
+                Mi = M[i]
+                try: 
+                    Mi.df, Mi.d2f = compute_sym_df_d2f_delays(Mi.f if Mi.fsymb is None else Mi.fsymb, Mi.n, Mi.m, Mi.p, 
+                                                              delays=Mi.delays, delays_idxs=Mi.delays_idxs, input_keys='xvp')
+                except Exception as e: 
+                    raise RuntimeError(f'Failed to obtain analytical derivatives for M[{i}].f.') from e
+
+            try: 
+                derivatives = compute_sym_df_d2f_many([(func, (M[i].n, M[i].m, M[i].p)) for i, _, func in symb], 
+                                                      input_keys='xvp', n_jobs=self._n_jobs)
+            except Exception as e: 
+                raise RuntimeError('Failed to obtain analytical derivatives for ' 
+                    + ', '.join(f'M[{i}].{k}' for i, k, _ in symb) + '.') from e
+
+            for (i, k, _), (df, d2f) in zip(symb, derivatives): 
+                M[i][f'd{k}'], M[i][f'd2{k}'] = df, d2f
+
+            print(f'Done. (compiled in {(time.time() - start_time):.2f}s)')
 
         # full priors on states
         for i in range(g): 
+            Mi = M[i]
 
             # hidden states
-            M[i].xP = np.empty(0) if M[i].xP is None else M[i].xP
-            if prod(M[i].xP.shape) == len(M[i].xP.shape): 
-                M[i].xP = np.eye(M[i].n) * M[i].xP.squeeze()
-            elif len(M[i].xP.shape) == 1 and M[i].xP.shape[0] == M[i].n: 
-                M[i].xP = np.diag(M[i].xP)
-            elif len(M[i].xP.shape) > 2 or (len(M[i].xP.shape) == 2 and any(dim != M[i].n for dim in M[i].xP.shape)):
-                raise ValueError(f'Wrong shape for M[{i}].xP: expected ({M[i].n},{M[i].n}), got {M[i].xP.shape}.')
+            Mi.xP = _EMPTY_1D if Mi.xP is None else Mi.xP
+            if Mi.xP.size == 1: 
+                Mi.xP = _scaled_eye(Mi.n, Mi.xP.squeeze())
+            elif len(Mi.xP.shape) == 1 and Mi.xP.shape[0] == Mi.n: 
+                Mi.xP = np.diag(Mi.xP)
+            elif len(Mi.xP.shape) > 2 or (len(Mi.xP.shape) == 2 and any(dim != Mi.n for dim in Mi.xP.shape)):
+                raise ValueError(f'Wrong shape for M[{i}].xP: expected ({Mi.n},{Mi.n}), got {Mi.xP.shape}.')
             else: 
-                M[i].xP = np.zeros((M[i].n, M[i].n))
+                Mi.xP = np.zeros((Mi.n, Mi.n))
 
             # hidden causes
-            M[i].vP = np.empty(0) if M[i].vP is None else M[i].vP
-            if prod(M[i].vP.shape) == len(M[i].vP.shape):   
-                M[i].vP = np.eye(M[i].n) * M[i].vP.squeeze()
-            elif len(M[i].vP.shape) == 1 and M[i].vP.shape[0] == M[i].n: 
-                M[i].vP = np.diag(M[i].vP)
-            elif len(M[i].vP.shape) > 2 or (len(M[i].vP.shape) == 2 and any(dim != M[i].n for dim in M[i].vP.shape)):
-                raise ValueError(f'Wrong shape for M[{i}].vP: expected ({M[i].n},{M[i].n}), got {M[i].vP.shape}.')
+            Mi.vP = _EMPTY_1D if Mi.vP is None else Mi.vP
+            if Mi.vP.size == 1: 
+                Mi.vP = _scaled_eye(Mi.n, Mi.vP.squeeze())
+            elif len(Mi.vP.shape) == 1 and Mi.vP.shape[0] == Mi.n: 
+                Mi.vP = np.diag(Mi.vP)
+            elif len(Mi.vP.shape) > 2 or (len(Mi.vP.shape) == 2 and any(dim != Mi.n for dim in Mi.vP.shape)):
+                raise ValueError(f'Wrong shape for M[{i}].vP: expected ({Mi.n},{Mi.n}), got {Mi.vP.shape}.')
             else: 
-                M[i].vP = np.zeros((M[i].n, M[i].n))
+                Mi.vP = np.zeros((Mi.n, Mi.n))
 
-        nx = sum(M[i].n for i in range(g))
+        self._index_levels(M)
+        nx = int(self.ns.sum())
 
         # Hyperparameters and components (causes: Q V and hidden states R, W)
         # ===================================================================
@@ -340,110 +502,21 @@ class HierarchicalGaussianModel(list):
         # -----------------------------------------------------------
         pP = 1
         for i in range(g):
+            Mi = M[i]
 
-            M[i].Q = [] if M[i].Q is None else M[i].Q
-            M[i].R = [] if M[i].R is None else M[i].R
-            M[i].V = np.empty(0) if M[i].V is None else M[i].V
-            M[i].W = np.empty(0) if M[i].W is None else M[i].W
+            # causes (Q, hE, hC, V) and hidden states (R, gE, gC, W) are checked the same way
+            Mi.Q, Mi.hE, Mi.hC = _check_components(Mi.Q, Mi.hE, Mi.hC, Mi.l, pP, i, 'Q', 'hE', 'hC')
+            Mi.R, Mi.gE, Mi.gC = _check_components(Mi.R, Mi.gE, Mi.gC, Mi.n, pP, i, 'R', 'gE', 'gC')
 
-            # check hyperpriors (expectation)
-            M[i].hE = np.zeros((len(M[i].Q), 1)) if M[i].hE is None else np.array(M[i].hE).reshape((-1,1))
-            M[i].gE = np.zeros((len(M[i].R), 1)) if M[i].gE is None else np.array(M[i].gE).reshape((-1,1))
-
-            #  check hyperpriors (covariances)
-            if M[i].hC is None: 
-                M[i].hC = np.eye(len(M[i].hE)) / pP 
-            else:
-                try:
-                    M[i].hC = np.array(M[i].hC).reshape((-1,1))
-                    M[i].hC * M[i].hE
-                except: 
-                    warnings.warn(f'Failed to compute M[{i}].hC * M[{i}].hE. Setting M[{i}].hC to identity.')
-                    M[i].hC = np.eye(len(M[i].hE)) / pP 
-
-            if M[i].gC is None: 
-                M[i].gC = np.eye(len(M[i].gE)) / pP 
-            else: 
-                try:
-                    M[i].gC = np.array(M[i].gC).reshape((-1,1))
-                    M[i].gC * M[i].gE
-                except: 
-                    warnings.warn(f'Failed to compute M[{i}].gC * M[{i}].hE. Setting M[{i}].gC to identity.')
-                    M[i].gC = np.eye(len(M[i].gE)) / pP 
- 
-            # check Q and R (precision components)
-
-            # check components and assume iid if not specified
-            if len(M[i].Q) > (M[i].hE.size): 
-                M[i].hE = np.zeros((len(M[i].Q), 1)) + M[i].hE[0]
-            elif len(M[i].Q) < (M[i].hE.size): 
-                M[i].Q  = [np.eye(M[i].l)]
-                M[i].hE = M[i].hE[0].reshape((1,1))
-
-            if M[i].hE.size == M[i].hC.size: 
-                M[i].hC = np.diag(M[i].hC.flat)
-            elif (M[i].hE.size) > (M[i].hC.size): 
-                M[i].hC = np.eye(len(M[i].Q)) * M[i].hC[0]
-            
-            if len(M[i].R) > (M[i].gE.size): 
-                M[i].gE = np.zeros((len(M[i].R), 1)) + M[i].gE[0]
-            elif len(M[i].R) < (M[i].gE.size): 
-                M[i].R = [np.eye(M[i].n)]
-                M[i].gE = M[i].gE[0].reshape((1,1))
-            
-            if M[i].gE.size == M[i].gC.size: 
-                M[i].gC = np.diag(M[i].gC.flat)
-            elif (M[i].gE.size) > (M[i].gC.size): 
-                M[i].gC = np.eye(len(M[i].R)) * M[i].gC[0]
-
-            # check consistency and sizes (Q)
-            # -------------------------------
-            for j in range(len(M[i].Q)):
-                if len(M[i].Q[j]) != M[i].l: 
-                    raise ValueError(f"Wrong shape for model[{i}].Q[{i}]"
-                                     f"(expected ({M[i].l},{M[i].l}), got {M[i].Q[j].shape})")
-            
-            # check consistency and sizes (R)
-            # -------------------------------
-            for j in range(len(M[i].R)):
-                if len(M[i].R[j]) != M[i].n: 
-                    raise ValueError(f"Wrong shape for model[{i}].R[{i}]"
-                                     f"(expected ({M[i].n},{M[i].n}), got {M[i].R[j].shape})")
-            
             # check V and W (lower bound on precisions)
             # -----------------------------------------
-            if len(M[i].V.shape) == 1 and len(M[i].V) == M[i].l: 
-                M[i].V = np.diag(M[i].V)
-            elif len(M[i].V) != M[i].l:
-                try: 
-                    M[i].V = np.eye(M[i].l) * M[i].V[0]                
-                except:
-                    if len(M[i].V) > 0: 
-                        warnings.warn(f'Failed to compute eye({M[i].l}) * M[{i}].V[0].')
-
-                    if len(M[i].hE) == 0:
-                        M[i].V = np.eye(M[i].l)
-                    else: 
-                        M[i].V = np.zeros((M[i].l, M[i].l))
-
-            if len(M[i].W.shape) == 1 and len(M[i].W) == M[i].n: 
-                M[i].W = np.diag(M[i].W)
-            elif len(M[i].W) != M[i].n:
-                try: 
-                    M[i].W = np.eye(M[i].n) * M[i].W[0]
-                except:
-                    if len(M[i].W) > 0: 
-                        warnings.warn(f'Failed to compute eye({M[i].n}) * M[{i}].W[0].')
-
-                    if len(M[i].gE) == 0:
-                        M[i].W = np.eye(M[i].n)
-                    else: 
-                        M[i].W = np.zeros((M[i].n,M[i].n))
+            Mi.V = _check_fixed_precision(Mi.V, Mi.l, Mi.hE, i, 'V')
+            Mi.W = _check_fixed_precision(Mi.W, Mi.n, Mi.gE, i, 'W')
 
             # check smoothness parameter
             s = 0 if nx == 0 else 1/2.
-            M[i].sv = s if M[i].sv is None else M[i].sv
-            M[i].sw = s if M[i].sw is None else M[i].sw
+            Mi.sv = s if Mi.sv is None else Mi.sv
+            Mi.sw = s if Mi.sw is None else Mi.sw
 
             self._prepared = True
             
@@ -0,0 +1,64 @@
+import numpy as np
+
+from .dem_structs import *
+
+
+def compute_num_df_d2f(func, *dims, input_keys=None, h=1e-5):
+    """
+    Use numerical differentiation to compute jacobian and hessian of a function of 3 vectors,
+    as a drop-in replacement of compute_sym_df_d2f for functions that cannot be traced symbolically.
+     - func: the function to differentiate, which must accept complex inputs (i.e. be written with numpy)
+     - dims: the (flat) dimensions of each argument
+     - h: step of the central differences used for second-order derivatives
+    Returns: (df, d2f) with the same layout as compute_sym_df_d2f, where:
+     - first-order derivatives use complex steps f(x + ie) (one evaluation per direction, exact to
+     machine precision)
+     - second-order derivatives use central differences of the complex-step derivatives
+    """
+    if input_keys is None:
+        import string
+        input_keys = string.ascii_lowercase[:len(dims)]
+    else:
+        assert(len(dims) == len(input_keys))
+
+    dims = tuple(0 if dim is None else dim for dim in dims)
+    keys = [f'd{k}' for k in input_keys]
+
+    # complex step (small enough for f(x + ie) = f(x) + ie f'(x) to hold exactly in double precision)
+    eps = 1e-20
+
+    def _args(args, i, a, step):
+        # args with step added to the a-th element of argument i
+        args    = list(args)
+        args[i] = np.array(args[i], dtype=np.complex128).reshape((-1, 1))
+        args[i][a, 0] += step
+        return args
+
+    def _df(args, i):
+        # complex-step jacobian wrt argument i, shape (l, dims[i])
+        if dims[i] == 0:
+            return np.zeros((np.size(func(*args)), 0))
+        return np.stack([
+            np.imag(func(*_args(args, i, a, 1j * eps))).reshape((-1,)) / eps
+            for a in range(dims[i])], axis=-1)
+
+    def _d2f(args, i, j):
+        # central differences (wrt argument j) of the jacobian wrt argument i, shape (l, dims[i], dims[j])
+        if dims[j] == 0:
+            return np.zeros((np.size(func(*args)), dims[i], 0))
+        return np.stack([
+            (_df(_args(args, j, b, h), i) - _df(_args(args, j, b, -h), i)) / (2 * h)
+            for b in range(dims[j])], axis=-1)
+
+    # callable dotdicts for output
+    df  = cdotdict()
+    d2f = cdotdict()
+    for i, d1 in enumerate(keys):
+        df[d1]  = lambda *args, _i=i: _df(args, _i)
+        d2f[d1] = cdotdict()
+
+        # we only populate the upper triangle (just use .swapaxes(1, 2) to get the other side)
+        for j, d2 in enumerate(keys[i:], i):
+            d2f[d1][d2] = lambda *args, _i=i, _j=j: _d2f(args, _i, _j)
+
+    return df, d2f
\ No newline at end of file
@@ -1,12 +1,22 @@
 class dotdict(dict):
     """dot.notation access to dictionary attributes"""
+    __slots__   = () # attributes are the items of the dict, so instances do not need a __dict__
     __getattr__ = dict.__getitem__
     __setattr__ = dict.__setitem__
     __delattr__ = dict.__delitem__
 
+    def __dir__(self): 
+        # there is no __dict__ to list attributes from
+        return [*dir(type(self)), *(k for k in self.keys() if isinstance(k, str))]
+
+    def __getstate__(self): 
+        # (for pickle) there is no state besides the items 
+        return None
+
 
 class cdotdict(dotdict):
     """callable dot dict""" 
+    __slots__ = ()
     def __call__(self, *args, **kwargs):
         return dotdict(
             zip(self.keys(),
@@ -15,6 +25,21 @@ class cdotdict(dotdict):
                     self.values())))
 
 
+class dxvp:
+    """derivatives wrt (x, v, p), as slots (faster to read than dotdict items) that can also be indexed by name"""
+    __slots__ = ('dx', 'dv', 'dp')
+    def __init__(self, dx=None, dv=None, dp=None):
+        self.dx = dx
+        self.dv = dv
+        self.dp = dp
+
+    def __getitem__(self, key): 
+        return getattr(self, key)
+
+    def __setitem__(self, key, value): 
+        setattr(self, key, value)
+
+
 class cell(list): 
     """emulates matlab's cell"""
     def __init__(self, m, n): 
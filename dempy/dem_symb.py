@@ -1,20 +1,35 @@
 import numpy as np
 import symengine as si
+import hashlib
+import os
+import pickle
+import platform
+import tempfile
 
 from itertools import chain, starmap, product
+from concurrent.futures import ProcessPoolExecutor
 
 from .dem_structs import *
 from .dem_defaults import dem_defaults
-from .utils import prod
+from .utils import prod, host_cpu_name
 
-def wrap_xvp(f): 
-    def _wraps(x,v,p): 
-        return np.array(
-            f(np.fromiter(chain(x.flat,v.flat,p.flat), dtype='d')), dtype='d')
+def wrap_xvp(f, shape=None, dtype='d'): 
+    # single call layer around a compiled kernel of the flat arguments (x, v, p)
+    if shape is None: 
+        def _wraps(x,v,p): 
+            return f(np.concatenate((x, v, p), axis=None).astype(dtype, copy=False))
+    else: 
+        def _wraps(x,v,p): 
+            return f(np.concatenate((x, v, p), axis=None).astype(dtype, copy=False)).reshape(shape)
     return _wraps
 
 
-def compile_symb_func(func, *dims, input_keys=None):
+def compile_symb_func(func, *dims, input_keys=None, real=True):
+    """
+    Compile the symbolic function func (forward evaluation only, no derivatives). 
+    If not real, the function accepts complex inputs (e.g. for compute_num_df_d2f), which the llvm 
+    backend does not support, so the slower lambda backend is used.
+    """
     if input_keys is None: 
         import string
         input_keys = string.ascii_lowercase[:len(dims)]
@@ -43,10 +58,17 @@ def compile_symb_func(func, *dims, input_keys=None):
 
     unpackvars = [*chain(*map(lambda v: v[1].flat, symvars))]
 
-    func = wrap_xvp(si.lambdify(unpackvars, symret, **dem_defaults.symengine.lambdify))
-    func = lambda x, v, p, _shape=(symret.shape[0], 1), _func=func: _func(x,v,p).reshape(_shape)
+    # kernels are memoized on the traced expression (tracing is cheap, compiling is not)
+    key = _symb_cache_key(si.Matrix(np.asarray(symret).reshape((symret.shape[0], prod(symret.shape[1:]))).tolist()), 'f', input_keys, flatdims, real)
+    if key not in _symb_memo: 
+        if real: 
+            _symb_memo[key] = si.Lambdify(unpackvars, symret, **dem_defaults.symengine.lambdify)
+        else: 
+            options = dict(dem_defaults.symengine.lambdify, backend='lambda', real=False)
+            options.pop('dtype', None)
+            _symb_memo[key] = si.Lambdify(unpackvars, symret, **options)
 
-    return func
+    return wrap_xvp(_symb_memo[key], (symret.shape[0], 1), dtype='d' if real else 'D')
 
 def compile_symb_func_delays(func, *dims, delays=None, delays_idxs=None, input_keys=None):
     if input_keys is None: 
@@ -96,26 +118,107 @@ def compile_symb_func_delays(func, *dims, delays=None, delays_idxs=None, input_k
 
     unpackvars = [*chain(*map(lambda v: v[1].flat, symvars))]
 
-    func = wrap_xvp(si.lambdify(unpackvars, symret, **dem_defaults.symengine.lambdify))
-    func = lambda x, v, p, _shape=(symret.shape[0], 1), _func=func: _func(x,v,p).reshape(_shape)
+    func = wrap_xvp(si.Lambdify(unpackvars, symret, **dem_defaults.symengine.lambdify), (symret.shape[0], 1))
 
     return func
 
 
-def compute_sym_df_d2f(func, *dims, input_keys=None, wrt=None):
-    """ 
-    Use symbolic differentiation to compute jacobian and hessian of a function of 3 vectors. 
-     - func: if the function to differentiate (must return a vector, ie a tensor (l, ...) where ... are empty or 1's)
-     - dims: a list of tuple containing the dimensions of each argument
-    Returns: (df, d2f) where: 
-     - df.dx, df.dv, and df.dp contains the jacobians wrt each argument
-     - d2f.dx.dx, ... contains the ndim-hessians wrt each pair of arguments
-    Note that for performance, only d2f[ki][kj] with input_keys.index(ki) < input_keys.index(kj) is populated
-    while d2f[kj][ki] is not. 
-    Use that fact that 'd2f[kj][ki] = d2f[ki][kj].swapaxes(1, 2)' to get it.  
+# compiled kernels of this process, by _symb_cache_key
+_symb_memo = dict()
+
+# version of the layout of compiled kernels (to be bumped when it changes, such that cached kernels are not reused)
+_SYMB_KERNELS_VERSION = 2
+
+def _exact_str(expr): 
+    # deterministic printout of expr, with floats in full (str() rounds them to 15 significant digits, and pickles 
+    # of symengine expressions differ between processes)
+    if isinstance(expr, si.RealDouble): 
+        return repr(float(expr))
+    if isinstance(expr, si.ComplexDouble): 
+        return repr(complex(expr))
+
+    args = expr.args
+    if not args: 
+        return str(expr)
+
+    children = [_exact_str(a) for a in args]
+    if isinstance(expr, (si.Add, si.Mul)): 
+        children.sort()
+    name = type(expr).__name__ + (expr.get_name() if hasattr(expr, 'get_name') else '')
+    return f"{name}({', '.join(children)})"
+
+def _symb_cache_key(fxvp, *specs): 
+    # key of a compiled set of derivatives: the traced expression and everything the compilation depends on
+    # (including the host, as llvm kernels contain machine code for its cpu)
+    spec = repr((fxvp.shape, [_exact_str(e) for e in fxvp], specs, _SYMB_KERNELS_VERSION, si.__version__, 
+                 sorted(dem_defaults.symengine.lambdify.items(), key=str), platform.machine(), host_cpu_name()))
+    return hashlib.sha1(spec.encode()).hexdigest()
+
+def _symb_cache_load(key): 
     """
-    cast = lambda x: np.array(x, dtype=np.float64)
-    
+    Compiled kernels cached under key, or None if there are none. 
+    Entries are unpickled, which can run arbitrary code: the cache directory (dem_defaults.symengine.cache_dir) 
+    must only be writable by trusted users. 
+    """
+    if dem_defaults.symengine.cache_dir is None: 
+        return None
+    try: 
+        with open(os.path.join(dem_defaults.symengine.cache_dir, f'{key}.pkl'), 'rb') as file: 
+            return pickle.load(file)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError): 
+        # no entry, or truncated or corrupted entry
+        return None
+
+def _symb_cache_save(key, kernels): 
+    if dem_defaults.symengine.cache_dir is None: 
+        return
+    try: 
+        os.makedirs(dem_defaults.symengine.cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile('wb', dir=dem_defaults.symengine.cache_dir, delete=False) as file: 
+            pickle.dump(kernels, file)
+        os.replace(file.name, os.path.join(dem_defaults.symengine.cache_dir, f'{key}.pkl'))
+    except Exception: 
+        # the cache is an optimization only
+        pass
+
+class _shared_cdotdict(cdotdict): 
+    """callable dot dict whose items are all evaluated at once, by a single (shared) function""" 
+    __slots__ = ('_shared',)
+
+    def __init__(self, shared, *args, **kwargs): 
+        super().__init__(*args, **kwargs)
+        object.__setattr__(self, '_shared', shared)
+
+    def __call__(self, *args, **kwargs): 
+        return self._shared(*args, **kwargs)
+
+def _compile_shared_kernel(blocks, unpackvars): 
+    # a single kernel for all the blocks with free (dependent) symbols, such that their common subexpressions 
+    # are eliminated together and they are evaluated in a single call, and the other blocks as constant arrays
+    cast   = lambda x: np.array(x, dtype=np.float64)
+    keys   = [k for k, block in blocks.items() if len(block.free_symbols) > 0]
+    consts = {k: cast(block.tolist()) for k, block in blocks.items() if len(block.free_symbols) == 0}
+    kernel = si.Lambdify(unpackvars, *(blocks[k] for k in keys), **dem_defaults.symengine.lambdify) if keys else None
+    return kernel, keys, consts
+
+def _wrap_shared_kernel(kernel, keys, consts, shapes): 
+    # function of (x, v, p) returning the dict of all blocks (with their target shapes)
+    consts = {k: const.reshape(shapes[k]) for k, const in consts.items()}
+    order  = [*shapes.keys()]
+
+    if kernel is None: 
+        return lambda *_args: consts
+
+    func = wrap_xvp(kernel)
+    def _evaluate(*args): 
+        out = func(*args)
+        out = [out] if len(keys) == 1 else out # Lambdify only returns a list for several outputs
+        out = {**consts, **{k: o.reshape(shapes[k]) for k, o in zip(keys, out)}}
+        return {k: out[k] for k in order}
+    return _evaluate
+
+def _trace_sym_func(func, *dims, input_keys=None, wrt=None): 
+    # trace func on symbolic arguments, returns the traced expression and the layout of its derivatives
     if input_keys is None: 
         import string
         input_keys = string.ascii_lowercase[:len(dims)]
@@ -138,31 +241,33 @@ def compute_sym_df_d2f(func, *dims, input_keys=None, wrt=None):
     # compute flat dimension 
     flatdims = [prod(dim) for dim in dims]
 
-    # create symbolic variables
-    symvars = [
-        (f'd{k}', si.symarray(k, dim))
-        for k, dim in zip(input_keys, flatdims)
-    ]
-
-    # symbols in column numpy arrays
-    var = [
-        (k, symvar.reshape((-1, 1)))
-        for k, symvar in symvars
-    ]    
-    
-    # arguments for calling the function (numpy.ndarrays column vectors)
-    args = [v[1] for v in var]
+    # arguments for calling the function (numpy.ndarrays column vectors of symbolic variables)
+    args = [si.symarray(k, dim).reshape((-1, 1)) for k, dim in zip(input_keys, flatdims)]
 
     # Call function 
     # -------------
     fxvp = si.Matrix(func(*args).tolist())
+
+    return fxvp, (tuple(input_keys), tuple(wrt), tuple(flatdims)), squeezedims
+
+def _compile_sym_kernels(fxvp, input_keys, wrt, flatdims): 
+    # compiled (shared) kernels of the jacobians and hessians of fxvp (given as nested lists, since symengine 
+    # matrices cannot be pickled), with blocks [d1] and [d1, d2] (module-level, such that it can run in 
+    # worker processes)
+    fxvp = si.Matrix(fxvp)
     l = fxvp.shape[0]
 
+    # create symbolic variables (the same as the ones fxvp was traced with)
+    symvars = [
+        (f'd{k}', si.symarray(k, dim))
+        for k, dim in zip(input_keys, flatdims)
+    ]
+
     # arguments to lambdify wrt 
     unpackvars = [*chain(*map(lambda v: v[1].flat, symvars))]
 
     # arguments to differentiate wrt
-    symvars = [*map(lambda v: (v[0], si.Matrix(v[1].tolist())), symvars)]
+    symvars = [*map(lambda v: (v[0], si.Matrix(v[1].reshape((-1, 1)).tolist())), symvars)]
 
     # Compute first-order derivatives 
     # -------------------------------
@@ -172,16 +277,10 @@ def compute_sym_df_d2f(func, *dims, input_keys=None, wrt=None):
         if d in wrt
     })
 
-    # callable dotdicts for output 
-    df  = cdotdict()
-    d2f = cdotdict()
-
+    d2fsymb = dict()
     for i, (d1, sym1) in enumerate(symvars):
         if d1 not in wrt: continue 
             
-        if d1 not in d2f.keys():
-            d2f[d1] = cdotdict()
-            
         for j, (d2, sym2) in enumerate(symvars): 
             # Compute second-order derivatives
             # --------------------------------
@@ -190,8 +289,6 @@ def compute_sym_df_d2f(func, *dims, input_keys=None, wrt=None):
             if j < i: continue 
 
             if d2 not in wrt: continue                 
-            if d2 not in d2f.keys(): 
-                d2f[d2] = cdotdict()
 
             # use symmetry for d2f{j}/dx{i}^2 (removes n(n-1)/2 operations)
             if i ==  j:
@@ -215,28 +312,89 @@ def compute_sym_df_d2f(func, *dims, input_keys=None, wrt=None):
                         product(dfsymb[d1], sym2))])
 
             # make a SymEngine matrix
-            h  = si.Matrix(ret.reshape(l, sym1.shape[0]*sym2.shape[0]).tolist())
+            d2fsymb[d1, d2] = si.Matrix(ret.reshape(l, sym1.shape[0]*sym2.shape[0]).tolist())
+
+    # one kernel for all jacobians, and one for all hessians
+    return dict(df=_compile_shared_kernel(dfsymb, unpackvars), d2f=_compile_shared_kernel(d2fsymb, unpackvars))
+
+def _wrap_sym_kernels(kernels, l, input_keys, wrt, squeezedims): 
+    # target shapes of the blocks
+    keys    = [f'd{k}' for k in input_keys]
+    dshapes = {d1: (l, *squeezedims[i]) for i, d1 in enumerate(keys) if d1 in wrt}
+    hshapes = {(d1, d2): (l, *squeezedims[i], *squeezedims[j]) 
+        for i, d1 in enumerate(keys) for j, d2 in enumerate(keys) if j >= i and d1 in wrt and d2 in wrt}
+
+    dfunc = _wrap_shared_kernel(*kernels['df'],  dshapes)
+    hfunc = _wrap_shared_kernel(*kernels['d2f'], hshapes)
+
+    # evaluated derivatives wrt all of (x, v, p) are returned in slots rather than in dotdicts
+    struct = dxvp if [*dshapes.keys()] == ['dx', 'dv', 'dp'] else dotdict
+
+    def _d2f(*args): 
+        h   = hfunc(*args)
+        out = struct(**{d: struct() for d in dshapes.keys()})
+        for (d1, d2), hi in h.items(): 
+            out[d1][d2] = hi
+        return out
+
+    # callable dotdicts for output (calling them evaluates all blocks at once, while 
+    # each block remains callable on its own)
+    df  = _shared_cdotdict(lambda *args: struct(**dfunc(*args)))
+    d2f = _shared_cdotdict(_d2f)
+
+    for d1 in dshapes.keys(): 
+        df[d1]  = lambda *args, _k=d1: dfunc(*args)[_k]
+        d2f[d1] = cdotdict()
+
+    for d1, d2 in hshapes.keys(): 
+        d2f[d1][d2] = lambda *args, _k=(d1, d2): hfunc(*args)[_k]
+        
+    return df, d2f
 
-            # create a function if h has free (dependent) symbols
-            if len(h.free_symbols) > 0: 
-                func_h  = wrap_xvp(si.lambdify(unpackvars, h, **dem_defaults.symengine.lambdify))
+def compute_sym_df_d2f(func, *dims, input_keys=None, wrt=None):
+    """ 
+    Use symbolic differentiation to compute jacobian and hessian of a function of 3 vectors. 
+     - func: if the function to differentiate (must return a vector, ie a tensor (l, ...) where ... are empty or 1's)
+     - dims: a list of tuple containing the dimensions of each argument
+    Returns: (df, d2f) where: 
+     - df.dx, df.dv, and df.dp contains the jacobians wrt each argument
+     - d2f.dx.dx, ... contains the ndim-hessians wrt each pair of arguments
+    Note that for performance, only d2f[ki][kj] with input_keys.index(ki) < input_keys.index(kj) is populated
+    while d2f[kj][ki] is not. 
+    Use that fact that 'd2f[kj][ki] = d2f[ki][kj].swapaxes(1, 2)' to get it.  
+    Compiled derivatives are cached on disk in dem_defaults.symengine.cache_dir (set it to None to disable).
+    """
+    return compute_sym_df_d2f_many([(func, dims)], input_keys=input_keys, wrt=wrt)[0]
 
-                d2f[d1][d2] = lambda *_args, _func=func_h, _target_shape=(l, *squeezedims[i], *squeezedims[j]):\
-                    _func(*_args).reshape(_target_shape)
+def compute_sym_df_d2f_many(funcs, input_keys=None, wrt=None, n_jobs=1): 
+    """ 
+    Same as compute_sym_df_d2f for a list of (func, dims) pairs, returns a list of (df, d2f). 
+    Functions are traced in the current process, and the derivatives that are not cached yet are 
+    computed and compiled in n_jobs processes (only the traced expressions and the compiled 
+    kernels are exchanged with the workers, so func does not have to be picklable). 
+    Compilation is serial unless n_jobs > 1. On platforms that spawn processes (macOS, Windows), workers 
+    re-import the __main__ module, so scripts using n_jobs > 1 must run under `if __name__ == '__main__':`. 
+    """
+    traced  = [_trace_sym_func(func, *dims, input_keys=input_keys, wrt=wrt) for func, dims in funcs]
+    keys    = [_symb_cache_key(fxvp, *spec) for fxvp, spec, _ in traced]
+    kernels = [_symb_memo[key] if key in _symb_memo else _symb_cache_load(key) for key in keys]
+    missing = [k for k, kernel in enumerate(kernels) if kernel is None]
+
+    if n_jobs > 1 and len(missing) > 1: 
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(missing))) as executor: 
+            futures = [executor.submit(_compile_sym_kernels, traced[k][0].tolist(), *traced[k][1]) for k in missing]
+            for k, future in zip(missing, futures): 
+                kernels[k] = future.result()
+    else: 
+        for k in missing: 
+            kernels[k] = _compile_sym_kernels(traced[k][0].tolist(), *traced[k][1])
 
-            else:
-                d2f[d1][d2] = lambda *_args, _symb=cast(h.tolist()).reshape((l, *squeezedims[i], *squeezedims[j])): _symb
-              
-        # create a jacobian if J has free (dependent) symbols
-        J = dfsymb[d1]
-        if len(J.free_symbols) > 0:
-            func_J  = wrap_xvp(si.lambdify(unpackvars, J, **dem_defaults.symengine.lambdify))
+    for k in missing: 
+        _symb_cache_save(keys[k], kernels[k])
+    _symb_memo.update(zip(keys, kernels))
 
-            df[d1] = lambda *_args, _func=func_J, _target_shape=(l, *squeezedims[i]): _func(*_args).reshape(_target_shape)
-        else: 
-            df[d1] = lambda *_args, _symb=cast(J.tolist()).reshape((l, *squeezedims[i])): _symb
-        
-    return df, d2f
+    return [_wrap_sym_kernels(kernel, fxvp.shape[0], *spec[:2], squeezedims) 
+            for kernel, (fxvp, spec, squeezedims) in zip(kernels, traced)]
 
 
 def compute_sym_df_d2f_delays(func, *dims, delays=None, delays_idxs=None, input_keys=None, wrt=None):
@@ -422,10 +580,8 @@ def compute_sym_df_d2f_delays(func, *dims, delays=None, delays_idxs=None, input_
 
             # create a function if h has free (dependent) symbols
             if len(H.free_symbols) > 0: 
-                func_h  = wrap_xvp(si.lambdify(unpackvars, H, **dem_defaults.symengine.lambdify))
-
-                d2f[d1][d2] = lambda *_args, _func=func_h, _target_shape=(l, *squeezedims[i], *squeezedims[j]):\
-                    _func(*_args).reshape(_target_shape)
+                d2f[d1][d2] = wrap_xvp(si.Lambdify(unpackvars, H, **dem_defaults.symengine.lambdify), 
+                    (l, *squeezedims[i], *squeezedims[j]))
 
             else:
                 d2f[d1][d2] = lambda *_args, _symb=cast(H.tolist()).reshape((l, *squeezedims[i], *squeezedims[j])): _symb
@@ -440,9 +596,7 @@ def compute_sym_df_d2f_delays(func, *dims, delays=None, delays_idxs=None, input_
         
         # create a function if J has free (dependent) symbols
         if len(J.free_symbols) > 0:
-            func_J  = wrap_xvp(si.lambdify(unpackvars, J, **dem_defaults.symengine.lambdify))
-
-            df[d1] = lambda *_args, _func=func_J, _target_shape=(l, *squeezedims[i]): _func(*_args).reshape(_target_shape)
+            df[d1] = wrap_xvp(si.Lambdify(unpackvars, J, **dem_defaults.symengine.lambdify), (l, *squeezedims[i]))
         else: 
             df[d1] = lambda *_args, _symb=cast(J.tolist()).reshape((l, *squeezedims[i])): _symb
         
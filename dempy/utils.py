@@ -12,6 +12,44 @@ except ImportError:
 	def matrix_exp(m):
 		return expm(m)
 
+# --- njit
+try: 
+	from numba import njit
+except ImportError: 
+	def njit(*args, **kwargs):
+		# run in pure python when numba is not installed
+		if len(args) == 1 and callable(args[0]) and not kwargs: 
+			return args[0]
+		return lambda f: f
+
+# --- host_cpu_name
+try: 
+	from llvmlite.binding import get_host_cpu_name as host_cpu_name
+except ImportError: 
+	import platform
+
+	def host_cpu_name():
+		# cpu model, from /proc/cpuinfo when available (platform.processor() is often empty on linux)
+		try: 
+			with open('/proc/cpuinfo') as file: 
+				for line in file: 
+					if line.startswith('model name'): 
+						return line.split(':', 1)[1].strip()
+		except OSError: 
+			pass
+		return platform.processor()
+
+# --- cholesky
+from scipy.linalg import cho_factor, cho_solve
+
+def cho_logdet(c): 
+    # log-determinant of a positive definite matrix from its factor c = cho_factor(a)
+    return 2 * np.log(np.diag(c[0])).sum()
+
+def cho_inv(a): 
+    # inverse of a positive definite matrix
+    return cho_solve(cho_factor(a), np.eye(*a.shape), overwrite_b=True)
+
 # --- prod
 try:
     from math import prod
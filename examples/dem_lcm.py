@@ -24,27 +24,31 @@ models = [
     ), 
     GaussianModel(l=1, V=np.array([np.exp(32.)]))
 ]
-genmodel = HierarchicalGaussianModel(*models)
 
-nT = 32
-t  = np.arange(1, nT+1)  
-u  = (np.exp(-(t - 12)**2/4))[:, None]
-gen = DEMInversion(genmodel, states_embedding_order=4).generate(nT, u)
-y   = gen.v[:,0,:4]
+# compiling derivatives in several processes (n_jobs > 1) re-imports this script on platforms that 
+# spawn processes (macOS, Windows), so the model is built and run under the main guard
+if __name__ == '__main__':
+    genmodel = HierarchicalGaussianModel(*models)
 
+    nT = 32
+    t  = np.arange(1, nT+1)  
+    u  = (np.exp(-(t - 12)**2/4))[:, None]
+    gen = DEMInversion(genmodel, states_embedding_order=4).generate(nT, u)
+    y   = gen.v[:,0,:4]
 
-figs = plot_dem_generate(genmodel, gen, show=False)
-for level, fig in enumerate(figs):
-    fig.update_layout(title_text=f"Generated trajectories (level {level + 1})", title_x=0.5)
-    fig.show()
 
-decmodel = genmodel.copy()
-decmodel[1].V = np.ones((1,1))
+    figs = plot_dem_generate(genmodel, gen, show=False)
+    for level, fig in enumerate(figs):
+        fig.update_layout(title_text=f"Generated trajectories (level {level + 1})", title_x=0.5)
+        fig.show()
 
-deminv  = DEMInversion(decmodel, states_embedding_order=4)
-dec = deminv.run(y, nD=1, nE=1, nM=1, K=1, td=1)
+    decmodel = genmodel.copy()
+    decmodel[1].V = np.ones((1,1))
 
-figs = plot_dem_states(decmodel, dec, gen, show=False)
-for level, fig in enumerate(figs):
-    fig.update_layout(title_text=f"Reconstructed trajectories (level {level + 1})", title_x=0.5)
-    fig.show()
\ No newline at end of file
+    deminv  = DEMInversion(decmodel, states_embedding_order=4)
+    dec = deminv.run(y, nD=1, nE=1, nM=1, K=1, td=1)
+
+    figs = plot_dem_states(decmodel, dec, gen, show=False)
+    for level, fig in enumerate(figs):
+        fig.update_layout(title_text=f"Reconstructed trajectories (level {level + 1})", title_x=0.5)
+        fig.show()
\ No newline at end of file
@@ -23,23 +23,26 @@ models = [GaussianModel(
     V=np.array([[np.exp(0)]]), 
 )]
 
-nT = 2**12
-hdm = HierarchicalGaussianModel(*models)
-gen = DEMInversion(hdm, states_embedding_order=3).generate(nT)
-y   = gen.v[:, 0, :1]
-
-figs = plot_dem_generate(hdm, gen, show=False)
-for level, fig in enumerate(figs):
-    fig.update_layout(title_text=f"Generated trajectories (level {level + 1})", title_x=0.5)
-    fig.show()
-
-hdm[0]['x']  = np.array([[12,13,16]])
-hdm[0]['pC'] = np.diag(np.ones(pE.shape)) * np.exp(-128)
-
-deminv = DEMInversion(hdm, states_embedding_order=8)
-dec    = deminv.run(y, nD=1, nE=1, nM=1)
-
-figs = plot_dem_states(hdm, dec, gen, show=False)
-for level, fig in enumerate(figs):
-    fig.update_layout(title_text=f"Reconstructed trajectories (level {level + 1})", title_x=0.5)
-    fig.show()
\ No newline at end of file
+# compiling derivatives in several processes (n_jobs > 1) re-imports this script on platforms that 
+# spawn processes (macOS, Windows), so the model is built and run under the main guard
+if __name__ == '__main__':
+    nT = 2**12
+    hdm = HierarchicalGaussianModel(*models)
+    gen = DEMInversion(hdm, states_embedding_order=3).generate(nT)
+    y   = gen.v[:, 0, :1]
+
+    figs = plot_dem_generate(hdm, gen, show=False)
+    for level, fig in enumerate(figs):
+        fig.update_layout(title_text=f"Generated trajectories (level {level + 1})", title_x=0.5)
+        fig.show()
+
+    hdm[0]['x']  = np.array([[12,13,16]])
+    hdm[0]['pC'] = np.diag(np.ones(pE.shape)) * np.exp(-128)
+
+    deminv = DEMInversion(hdm, states_embedding_order=8)
+    dec    = deminv.run(y, nD=1, nE=1, nM=1)
+
+    figs = plot_dem_states(hdm, dec, gen, show=False)
+    for level, fig in enumerate(figs):
+        fig.update_layout(title_text=f"Reconstructed trajectories (level {level + 1})", title_x=0.5)
+        fig.show()
\ No newline at end of file